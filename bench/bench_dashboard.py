@@ -0,0 +1,104 @@
+"""后台首页查询基准：旧版（关联子查询 + OFFSET + 4 次聚合）对比当前实现。
+
+用法（DATABASE_URL 指向专用测试库）：
+    python -m bench.bench_dashboard --users 1000000 --seed
+"""
+import argparse
+import logging
+import statistics
+import time
+
+import main
+from bench.seed import seed_users
+
+LEGACY_PAGE_SQL = """
+    SELECT u.user_id, u.first_name, u.last_name, u.username, u.phone, u.points, u.plays,
+           u.created_at, u.last_play, u.invited_by, u.is_blocked,
+           i.username AS inviter_username,
+           COALESCE((SELECT COUNT(*) FROM users u2 WHERE u2.invited_by = u.user_id), 0) AS invite_count
+    FROM users u
+    LEFT JOIN users i ON u.invited_by = i.user_id
+    ORDER BY u.created_at DESC
+    LIMIT %s OFFSET %s
+"""
+
+LEGACY_STATS_SQL = [
+    "SELECT COUNT(*) FROM users u LEFT JOIN users i ON u.invited_by = i.user_id",
+    "SELECT COUNT(*) FROM users",
+    "SELECT COUNT(*) FROM users WHERE phone IS NOT NULL",
+    "SELECT COUNT(*) FROM users WHERE is_blocked = 1",
+    "SELECT COALESCE(SUM(points), 0) FROM users",
+]
+
+
+def legacy_dashboard(offset):
+    with main.get_conn() as conn, conn.cursor() as c:
+        for sql in LEGACY_STATS_SQL:
+            c.execute(sql)
+            c.fetchone()
+        c.execute(LEGACY_PAGE_SQL, (20, offset))
+        c.fetchall()
+
+
+def timed(label, fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<28} p50 {statistics.median(samples):9.1f} ms   p95 {p95:9.1f} ms")
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--seed", action="store_true", help="先生成模拟用户")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--deep-offset", type=int, default=500_000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    main.init_db()
+    if args.seed:
+        with main.get_conn() as conn:
+            seed_users(conn, args.users)
+
+    with main.get_conn() as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT created_at, user_id FROM users
+            ORDER BY created_at DESC, user_id DESC
+            OFFSET %s LIMIT 1
+        """, (args.deep_offset - 1,))
+        row = c.fetchone()
+    deep_cursor = main.encode_cursor(*row) if row else ""
+
+    client = main.app.test_client()
+
+    def current(path):
+        def fetch():
+            main.response_cache.invalidate()
+            main.stats_cache.invalidate()
+            main.count_cache.invalidate()
+            assert client.get(path).status_code == 200
+        return fetch
+
+    def current_cached(path):
+        # 只保留统计缓存，整页响应缓存每次清掉，测的仍是查询本身
+        def fetch():
+            main.response_cache.invalidate()
+            assert client.get(path).status_code == 200
+        return fetch
+
+    timed("旧版 第 1 页", lambda: legacy_dashboard(0), args.runs)
+    timed("当前 第 1 页（无缓存）", current("/"), args.runs)
+    timed("当前 第 1 页（统计已缓存）", current_cached("/"), args.runs)
+    timed("当前 第 1 页（响应已缓存）", lambda: client.get("/"), args.runs)
+    timed(f"旧版 偏移 {args.deep_offset}", lambda: legacy_dashboard(args.deep_offset), args.runs)
+    timed(f"当前 偏移 {args.deep_offset}", current(f"/?after={deep_cursor}"), args.runs)
+    timed("当前 关键词搜索", current("/?keyword=user12345"), args.runs)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,212 @@
+"""骰子游戏吞吐量压测。
+
+启动模拟 Bot API（子进程，不和机器人抢事件循环），用 main.build_bot_application()
+构建机器人并把合成的群组骰子更新按固定速率放进 update_queue，走真实的 handler、
+定时步骤、发送队列和数据库。结束后输出每秒结算局数、各 handler 的 p50/p99 耗时、
+每条更新的数据库语句数（cursor.execute 次数）、按名字的连接借用次数和 Bot API 调用数。
+
+用法（DATABASE_URL 指向专用测试库）：
+    python -m bench.bench_games --seed --users 100000 --history 1000000
+    python -m bench.bench_games --updates 5000 --rate 500 --players 2000
+    python -m bench.bench_games --telegram-limits   # 保留 Telegram 的发送限速
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from psycopg2.extensions import cursor as pg_cursor
+from telegram import Update
+
+import main
+from bench.fake_telegram import BENCH_CHAT_ID, dice_update
+from bench.seed import SEED_USER_ID_BASE, prepare_players, seed_game_history, seed_users
+
+
+def record_samples(histogram):
+    """在 histogram 照常统计的同时保留原始样本，用来算分位数。"""
+    samples = defaultdict(list)
+    observe = histogram.observe
+
+    def observe_and_keep(value, *labels):
+        samples[labels[0]].append(value)
+        observe(value, *labels)
+
+    histogram.observe = observe_and_keep
+    return samples
+
+
+class StatementCounter:
+    """给连接池借出的连接换上计数游标，统计真正发到数据库的语句数。
+
+    db_query_seconds 按借用连接的次数计数，一次借用里可能执行多条语句，不能当作查询数。
+    execute_values 每页调用一次 execute，按往返次数计；服务端游标的后续 FETCH 不计入。
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        counter = self
+
+        class CountingCursor(pg_cursor):
+            def execute(self, query, vars=None):
+                with counter._lock:
+                    counter.count += 1
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                with counter._lock:
+                    counter.count += 1
+                return super().executemany(query, vars_list)
+
+        self.cursor_factory = CountingCursor
+
+    def install(self, pool):
+        checkout = pool._checkout
+
+        def counting_checkout():
+            conn = checkout()
+            conn.cursor_factory = self.cursor_factory
+            return conn
+        pool._checkout = counting_checkout
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def print_latencies(title, samples):
+    print(title)
+    for name, values in sorted(samples.items()):
+        values.sort()
+        print(f"  {name:<22} n={len(values):<7} p50 {statistics.median(values) * 1000:8.2f} ms"
+              f"   p99 {percentile(values, 0.99) * 1000:8.2f} ms")
+
+
+async def drive(application, args):
+    start = time.monotonic()
+    for i in range(args.updates):
+        user_id = SEED_USER_ID_BASE + i % args.players
+        chat_id = BENCH_CHAT_ID - i % args.chats
+        await application.update_queue.put(Update.de_json(dice_update(i + 1, user_id, chat_id), application.bot))
+        delay = start + (i + 1) / args.rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def wait_idle(application, timeout):
+    deadline = time.monotonic() + timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        busy = (application.update_queue.qsize() or main._games_in_flight
+                or main.outbox.stats()["queue_depth"] or main.history_buffer._rows)
+        if busy:
+            idle_since = None
+        elif idle_since is None:
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > 0.5:
+            return idle_since
+        await asyncio.sleep(0.05)
+    raise TimeoutError("压测在超时前没有结束")
+
+
+async def bench(args):
+    api = subprocess.Popen([sys.executable, "-m", "bench.fake_telegram", "serve", "--port", str(args.api_port)])
+    tasks = []
+    try:
+        await asyncio.sleep(2)
+        main.BOT_TOKEN = "123456:BENCH"
+        main.BOT_API_BASE_URL = f"http://127.0.0.1:{args.api_port}/bot"
+        main.GAME_ROLL_DELAY = args.roll_delay
+        if not args.telegram_limits:
+            main.OUTBOX_GROUP_RATE_PER_MIN = main.OUTBOX_PRIVATE_RATE = 1e9
+            main.OUTBOX_GLOBAL_RATE = 1e9
+            main.outbox = main.Outbox()
+
+        application = main.build_bot_application()
+        await application.initialize()
+        await application.start()
+        main.scheduler.start()
+        tasks = [asyncio.create_task(main.outbox.run()), asyncio.create_task(main.reward_worker.run())]
+        if main.history_buffer.enabled:
+            tasks.append(asyncio.create_task(main.history_buffer.run()))
+
+        handler_samples = record_samples(main.handler_seconds)
+        api_samples = record_samples(main.bot_api_seconds)
+        statements = StatementCounter()
+        statements.install(main.db)
+        borrows_before = main.db_query_seconds.counts()
+        api_before = sum(main.bot_api_calls.values())
+        rejections_before = sum(main.game_rejections.counts().values())
+        aborted_before = sum(main.games_aborted.counts().values())
+        settled_before = sum(main.games_total.counts().values())
+
+        start = time.monotonic()
+        await drive(application, args)
+        finished = await wait_idle(application, args.timeout)
+        elapsed = finished - start
+
+        borrows = main.db_query_seconds.counts()
+        statement_count = statements.count
+        settled = sum(main.games_total.counts().values()) - settled_before
+        rejected = sum(main.game_rejections.counts().values()) - rejections_before
+        aborted = sum(main.games_aborted.counts().values()) - aborted_before
+        api_calls = sum(main.bot_api_calls.values()) - api_before
+
+        print(f"更新 {args.updates} 条，结算 {settled} 局，拒绝 {rejected}，中止 {aborted}，"
+              f"对局进行中被忽略 {args.updates - settled - rejected - aborted}")
+        print(f"用时 {elapsed:.1f}s，{settled / elapsed:.1f} 局/秒")
+        print_latencies("handler 耗时", handler_samples)
+        # 模拟 API 本身的耗时；这里明显变大说明瓶颈在模拟 API 而不是机器人
+        print_latencies("Bot API 耗时", api_samples)
+        print("数据库连接借用（按名字，一次借用可能执行多条语句）")
+        for (name,), count in sorted(borrows.items()):
+            count -= borrows_before.get((name,), 0)
+            print(f"  {name:<22} {count / args.updates:.3f} 次借用/更新")
+        print(f"合计：数据库语句 {statement_count / args.updates:.3f} 条/更新，"
+              f"Bot API 调用 {api_calls / args.updates:.3f} 次/更新")
+
+        await application.stop()
+        await application.shutdown()
+    finally:
+        for task in tasks:
+            task.cancel()
+        api.terminate()
+        api.wait()
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", action="store_true", help="先生成模拟用户和游戏记录")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--history", type=int, default=0, help="生成的游戏记录条数")
+    parser.add_argument("--players", type=int, default=1000, help="参与压测的用户数，每人每天最多 10 局")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="每秒发送的更新数")
+    parser.add_argument("--roll-delay", type=float, default=0.2, help="覆盖 GAME_ROLL_DELAY")
+    parser.add_argument("--telegram-limits", action="store_true", help="保留发送队列的 Telegram 限速")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    main.init_db()
+    with main.get_conn() as conn:
+        if args.seed:
+            seed_users(conn, max(args.users, args.players))
+            if args.history:
+                seed_game_history(conn, args.history, args.users)
+        prepare_players(conn, args.players)
+    main.leaderboard.load(main.db.run(main._load_leaderboard))
+
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    run()
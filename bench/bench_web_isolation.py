@@ -0,0 +1,134 @@
+"""后台压测时机器人延迟是否受影响。
+
+同一事件循环里跑 Hypercorn（main.asgi_app）和一个模拟机器人 handler 的探针：
+探针按固定间隔做一次和门槛检查相同的查询（经过 db.arun），记录从发起到返回的耗时。
+后台压力由若干线程并发请求带随机关键词的首页，走 ILIKE 扫描；每个请求另带一个不重复的
+nocache 参数，关键词重复或跨阶段时也不会命中响应缓存。
+
+用法（DATABASE_URL 指向专用测试库）：
+    python -m bench.bench_web_isolation --users 200000 --seed
+    python -m bench.bench_web_isolation --separate   # 额外测一轮 WEB_MODE=separate
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+import main
+from bench.seed import SEED_USER_ID_BASE, seed_users
+
+
+def _gate_lookup(c, user_id):
+    c.execute("SELECT is_blocked, plays, phone FROM users WHERE user_id = %s", (user_id,))
+    return c.fetchone()
+
+
+async def probe(duration, interval, users):
+    samples = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        await main.db.arun(_gate_lookup, SEED_USER_ID_BASE + random.randrange(users))
+        samples.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(interval)
+    return samples
+
+
+_request_ids = itertools.count()
+
+
+def dashboard_load(url, concurrency, stop):
+    done = []
+
+    def worker():
+        with httpx.Client(timeout=60) as client:
+            while not stop.is_set():
+                client.get(url, params={"keyword": f"user{random.randrange(100000)}",
+                                        "nocache": next(_request_ids)})
+                done.append(1)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    return threads, done
+
+
+async def phase(label, url, args):
+    stop = threading.Event()
+    threads, done = dashboard_load(url, args.concurrency, stop) if url else ([], [])
+    start = time.monotonic()
+    samples = await probe(args.duration, args.interval, args.users)
+    elapsed = time.monotonic() - start
+    stop.set()
+    for t in threads:
+        await asyncio.to_thread(t.join)
+    samples.sort()
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{label:<24} 机器人 p50 {statistics.median(samples):8.1f} ms   p99 {p99:8.1f} ms"
+          f"   后台 {len(done) / elapsed:6.1f} req/s")
+
+
+async def bench(args):
+    shutdown = asyncio.Event()
+    config = Config()
+    config.bind = [f"127.0.0.1:{args.port}"]
+    config.accesslog = None
+    server = asyncio.create_task(serve(main.asgi_app, config, shutdown_trigger=shutdown.wait))
+    await asyncio.sleep(1)
+    url = f"http://127.0.0.1:{args.port}/"
+
+    await phase("空闲", None, args)
+
+    bounded = main.web_executor
+    main.web_executor = None
+    await phase("默认线程池", url, args)
+    main.web_executor = bounded
+    await phase(f"有界线程池（{main.WEB_THREADS}）", url, args)
+
+    shutdown.set()
+    await server
+
+    if args.separate:
+        env = dict(os.environ, WEB_BIND=f"127.0.0.1:{args.port + 1}")
+        web = subprocess.Popen([sys.executable, "main.py", "web"], env=env)
+        try:
+            await asyncio.sleep(3)
+            await phase(f"独立进程（{main.WEB_PROCESSES}）", f"http://127.0.0.1:{args.port + 1}/", args)
+        finally:
+            web.terminate()
+            web.wait()
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--seed", action="store_true", help="先生成模拟用户")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--interval", type=float, default=0.02, help="探针间隔（秒）")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发后台请求数")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--separate", action="store_true", help="再测一轮独立后台进程")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    main.init_db()
+    if args.seed:
+        with main.get_conn() as conn:
+            seed_users(conn, args.users)
+
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    run()
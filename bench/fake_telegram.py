@@ -0,0 +1,165 @@
+"""本地模拟的 Telegram Bot API，以及合成更新的发送工具。
+
+启动模拟 API（机器人设置 BOT_API_BASE_URL=http://127.0.0.1:8081/bot）：
+    python -m bench.fake_telegram serve --port 8081
+
+向 Webhook 发送合成的群组骰子更新：
+    python -m bench.fake_telegram post --url http://127.0.0.1:8080/telegram/webhook --count 1000 --rate 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+BENCH_CHAT_ID = -1001000000000
+BENCH_USER_ID_BASE = 1_000_000_000
+
+
+class FakeTelegramAPI:
+    """实现机器人用到的 Bot API 方法；sendDice 返回随机点数，getUpdates 返回 enqueue() 入队的更新。"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.updates = asyncio.Queue()
+        self._message_ids = itertools.count(1)
+
+    def enqueue(self, update):
+        self.updates.put_nowait(update)
+
+    def _message(self, params, **extra):
+        chat_id = int(params.get("chat_id", BENCH_CHAT_ID))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"},
+            **extra,
+        }
+
+    async def _get_updates(self, params):
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def call(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": True,
+                    "supports_inline_queries": False}
+        if method == "sendDice":
+            return self._message(params, dice={"emoji": "🎲", "value": random.randint(1, 6)})
+        if method == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        method = scope["path"].rsplit("/", 1)[-1]
+        headers = dict(scope["headers"])
+        if headers.get(b"content-type", b"").startswith(b"application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        result = await self.call(method, params)
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": payload})
+
+
+def dice_update(update_id, user_id, chat_id=BENCH_CHAT_ID):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "dice": {"emoji": "🎲", "value": random.randint(1, 6)},
+        },
+    }
+
+
+async def post_updates(url, count, rate, users, secret=None, concurrency=50):
+    """以大约 rate 条/秒的速度把 count 条合成骰子更新 POST 到 Webhook，返回状态码统计。"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError:
+                    statuses["error"] += 1
+
+        tasks = []
+        start = time.monotonic()
+        for i in range(count):
+            update = dice_update(i + 1, BENCH_USER_ID_BASE + random.randrange(users))
+            tasks.append(asyncio.create_task(post(update)))
+            delay = start + (i + 1) / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await asyncio.gather(*tasks)
+    return statuses
+
+
+async def serve_fake_api(port):
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    await serve(FakeTelegramAPI(), config)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve_parser = sub.add_parser("serve")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    post_parser = sub.add_parser("post")
+    post_parser.add_argument("--url", default="http://127.0.0.1:8080/telegram/webhook")
+    post_parser.add_argument("--secret")
+    post_parser.add_argument("--count", type=int, default=1000)
+    post_parser.add_argument("--rate", type=float, default=100)
+    post_parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "serve":
+        asyncio.run(serve_fake_api(args.port))
+    else:
+        statuses = asyncio.run(post_updates(args.url, args.count, args.rate, args.users, args.secret))
+        print(dict(statuses))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,115 @@
+"""本地验证多实例协调：同一个数据库上起 N 个进程。
+
+检查三件事：
+1. 同一时刻只有一个 leader；杀掉 leader 后其他实例在 COORDINATION_RETRY_SECONDS 内接手；
+2. 多个实例同时为同一用户开局，只有一个能占用成功；
+3. 每个实例 emit 的事件其他实例都能收到。
+
+用法（DATABASE_URL 指向专用测试库）：
+    python -m bench.replicas --count 3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+import main
+from bench.seed import SEED_USER_ID_BASE, prepare_players, seed_users
+
+received = set()
+
+
+@main.coordinator.on("ping")
+def _on_ping(_, instance):
+    received.add(instance)
+
+
+async def child(claim_at):
+    asyncio.create_task(main.coordinator.run())
+    await asyncio.sleep(max(0, claim_at - time.time()))
+    reserved, _ = await main.db.arun(main._reserve_play, SEED_USER_ID_BASE)
+    print(json.dumps({"instance": main.INSTANCE_ID, "claimed": reserved}), flush=True)
+    while True:
+        main.coordinator.emit("ping", instance=main.INSTANCE_ID)
+        print(json.dumps({"instance": main.INSTANCE_ID, "leader": main.coordinator.is_leader,
+                          "peers": sorted(received)}), flush=True)
+        await asyncio.sleep(1)
+
+
+async def read_status(proc, status):
+    async for line in proc.stdout:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        event["at"] = time.monotonic()
+        status.setdefault(proc.pid, {}).update(event)
+
+
+def leaders(status, alive, since=0):
+    return [pid for pid in alive
+            if status.get(pid, {}).get("leader") and status[pid]["at"] >= since]
+
+
+async def parent(args):
+    env = dict(os.environ, COORDINATION_ENABLED="1", COORDINATION_RETRY_SECONDS=str(args.retry))
+    claim_at = time.time() + 3
+    procs = [
+        await asyncio.create_subprocess_exec(sys.executable, "-m", "bench.replicas", "--child", str(claim_at),
+                                             env=env, stdout=asyncio.subprocess.PIPE)
+        for _ in range(args.count)
+    ]
+    status = {}
+    readers = [asyncio.create_task(read_status(p, status)) for p in procs]
+    alive = {p.pid: p for p in procs}
+    try:
+        await asyncio.sleep(5 + args.retry)
+        claimed = [pid for pid in alive if status.get(pid, {}).get("claimed")]
+        print(f"同时开局：{len(claimed)} / {len(alive)} 个实例占用成功（应为 1）")
+        current = leaders(status, alive)
+        print(f"leader：{current}（应恰好 1 个）")
+        for pid in alive:
+            peers = len(status.get(pid, {}).get("peers", []))
+            print(f"  实例 {pid} 收到 {peers} 个其他实例的事件（应为 {len(alive) - 1}）")
+
+        if current:
+            victim = current[0]
+            alive.pop(victim).send_signal(signal.SIGKILL)
+            start = time.monotonic()
+            while not leaders(status, alive, start) and time.monotonic() - start < args.retry * 3:
+                await asyncio.sleep(0.2)
+            print(f"杀掉 leader {victim} 后 {time.monotonic() - start:.1f}s 新 leader：{leaders(status, alive, start)}")
+    finally:
+        for p in alive.values():
+            p.terminate()
+        for r in readers:
+            r.cancel()
+        with main.get_conn() as conn, conn.cursor() as c:
+            main._release_play(c, SEED_USER_ID_BASE)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=3)
+    parser.add_argument("--retry", type=float, default=3, help="COORDINATION_RETRY_SECONDS")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.child is not None:
+        asyncio.run(child(args.child))
+        return
+
+    main.init_db()
+    with main.get_conn() as conn:
+        seed_users(conn, 1)
+        prepare_players(conn, 1)
+    asyncio.run(parent(args))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,79 @@
+"""往基准测试数据库里灌入模拟数据。
+
+只应指向专用的测试库：所有模拟用户的 user_id 都从 SEED_USER_ID_BASE 开始。
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+import main
+
+SEED_USER_ID_BASE = 1_000_000_000
+SEED_BATCH_SIZE = 100_000
+
+
+def seed_users(conn, count, batch_size=SEED_BATCH_SIZE):
+    """生成 count 个用户：约 1/3 已授权手机号、30% 有邀请人、1% 被封禁。"""
+    start = time.monotonic()
+    with conn.cursor() as c:
+        for low in range(0, count, batch_size):
+            high = min(low + batch_size, count) - 1
+            c.execute("""
+                INSERT INTO users (user_id, first_name, username, phone, points, plays,
+                                   created_at, last_play, invited_by, is_blocked)
+                SELECT %(base)s + g,
+                       'user' || g,
+                       'user' || g,
+                       CASE WHEN g %% 3 = 0 THEN '+86' || (13000000000 + g) END,
+                       (random() * 1000)::int,
+                       (random() * 10)::int,
+                       NOW() - make_interval(secs => %(count)s - g),
+                       CASE WHEN random() < 0.1 THEN NOW() - make_interval(secs => random() * 3600) END,
+                       CASE WHEN g > 0 AND random() < 0.3 THEN %(base)s + (random() * (g - 1))::bigint END,
+                       CASE WHEN random() < 0.01 THEN 1 ELSE 0 END
+                FROM generate_series(%(low)s, %(high)s) g
+                ON CONFLICT (user_id) DO NOTHING
+            """, {"base": SEED_USER_ID_BASE, "count": count, "low": low, "high": high})
+            conn.commit()
+            logging.info(f"已生成用户 {high + 1} / {count}")
+        c.execute("ANALYZE users")
+    conn.commit()
+    logging.info(f"用户数据生成完成，用时 {time.monotonic() - start:.1f}s")
+
+
+def seed_game_history(conn, count, user_count, batch_size=SEED_BATCH_SIZE):
+    """生成 count 条游戏记录，均匀分布在最近 30 天、前 user_count 个模拟用户上。"""
+    start = time.monotonic()
+    with conn.cursor() as c:
+        # 最近 30 天可能跨到上个月，当前月以后的分区启动时已经建好
+        earliest = datetime.now() - timedelta(days=30)
+        main._create_history_partition(c, datetime(earliest.year, earliest.month, 1))
+        for low in range(0, count, batch_size):
+            high = min(low + batch_size, count) - 1
+            c.execute("""
+                INSERT INTO game_history (user_id, created_at, user_score, bot_score, result, points_change)
+                SELECT %(base)s + (random() * (%(users)s - 1))::bigint,
+                       NOW() - make_interval(secs => random() * 30 * 86400),
+                       s.u, s.b,
+                       CASE WHEN s.u > s.b THEN '赢' WHEN s.u < s.b THEN '输' ELSE '平局' END,
+                       CASE WHEN s.u > s.b THEN 10 WHEN s.u < s.b THEN -5 ELSE 0 END
+                FROM generate_series(%(low)s, %(high)s) g,
+                     LATERAL (SELECT 1 + (random() * 5)::int + g * 0 AS u, 1 + (random() * 5)::int AS b) s
+            """, {"base": SEED_USER_ID_BASE, "users": user_count, "low": low, "high": high})
+            conn.commit()
+            logging.info(f"已生成游戏记录 {high + 1} / {count}")
+        c.execute("ANALYZE game_history")
+    conn.commit()
+    logging.info(f"游戏记录生成完成，用时 {time.monotonic() - start:.1f}s")
+
+
+def prepare_players(conn, count):
+    """把前 count 个模拟用户设为可以开局：已授权手机号、未封禁、今日次数清零。"""
+    with conn.cursor() as c:
+        c.execute("""
+            UPDATE users
+            SET phone = COALESCE(phone, '+86' || (13000000000 + user_id - %(base)s)),
+                is_blocked = 0, plays = 0
+            WHERE user_id >= %(base)s AND user_id < %(base)s + %(count)s
+        """, {"base": SEED_USER_ID_BASE, "count": count})
+    conn.commit()
@@ -1,10 +1,34 @@
 import os
+import sys
+import base64
+import bisect
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import re
+import json
+import socket
+import time
 import logging
+import threading
 import psycopg2
+import psycopg2.errors
 import asyncio
+import contextvars
+import heapq
+import itertools
 import nest_asyncio
-from datetime import datetime, date
-from flask import Flask, render_template, request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, date, timedelta
+from functools import partial, wraps
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_values
+from flask import Flask, Response, make_response, render_template, request, stream_with_context
 from flask import jsonify
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram import (
@@ -15,13 +39,19 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     CallbackQueryHandler, ChatMemberHandler, ContextTypes, filters
 )
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from hypercorn.app_wrappers import WSGIWrapper
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+from hypercorn.run import run as hypercorn_run
 from dotenv import load_dotenv
 
 load_dotenv()
 nest_asyncio.apply()
 logging.basicConfig(level=logging.INFO)
+# 每局游戏都会调度结算任务，避免 APScheduler 刷屏
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 
 app = Flask(__name__)
 
@@ -30,7 +60,7 @@ def format_datetime_filter(value):
     if not value:
         return "无"
     try:
-        dt = datetime.fromisoformat(value)
+        dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
         return dt.strftime("%Y-%m-%d %H:%M:%S")
     except Exception:
         return value
@@ -38,8 +68,423 @@ def format_datetime_filter(value):
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", 30))
+
+
+# ---------- 指标 ----------
+# /metrics 以 Prometheus 文本格式输出。只用标准库，一次观测只是一次二分查找和几次加法。
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0)
+
+metrics = []
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class CounterMetric:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def counts(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return "\n".join(lines)
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [各桶计数（最后一个是 +Inf）, 总和]
+        self._series = {}
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def counts(self):
+        """各标签组合的观测次数"""
+        with self._lock:
+            return {labels: sum(counts) for labels, (counts, _) in self._series.items()}
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_names = self.labelnames + ("le",)
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_names, labels + (bound,))} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return "\n".join(lines)
+
+
+def render_metrics():
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+handler_seconds = Histogram("bot_handler_duration_seconds", "Bot handler 执行耗时", ("handler",))
+handler_errors = CounterMetric("bot_handler_errors_total", "Bot handler 抛出的异常数", ("handler",))
+db_query_seconds = Histogram("db_query_duration_seconds", "数据库查询耗时，按查询名", ("query",))
+bot_api_seconds = Histogram("bot_api_request_duration_seconds", "Bot API 请求耗时", ("method",))
+bot_api_errors = CounterMetric("bot_api_errors_total", "失败的 Bot API 请求数", ("method",))
+job_seconds = Histogram("job_duration_seconds", "定时任务耗时", ("job",), JOB_BUCKETS)
+games_total = CounterMetric("games_total", "已结算的对局数", ("result",))
+games_aborted = CounterMetric("games_aborted_total", "因异常中止的对局数")
+game_rejections = CounterMetric("game_rejections_total", "开局被拒绝的次数", ("reason",))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DBPool:
+    """共享的 psycopg2 连接池。
+
+    Flask 路由通过 connection() 同步借用连接；bot handler 通过 arun()/fetchone()/
+    fetchall()/execute() 在专用线程池中执行查询，不会阻塞事件循环。
+    带 name 借用的连接和 run() 都会按名字记进 db_query_seconds。
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, health_check_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool 满了会直接抛错，用信号量让调用方排队等待
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix="db")
+        self._last_used = {}
+        self._stats = {
+            "acquired": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "discarded": 0,
+        }
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = pg_pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
+        self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._stats["health_check_failures"] += 1
+            return False
+
+    def _checkout(self):
+        pool = self._get_pool()
+        conn = pool.getconn()
+        if not self._is_healthy(conn):
+            self._discard(conn)
+            conn = pool.getconn()
+        return conn
+
+    def _discard(self, conn):
+        self._stats["discarded"] += 1
+        self._last_used.pop(id(conn), None)
+        self._get_pool().putconn(conn, close=True)
+
+    @contextmanager
+    def connection(self, name=None):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                self._stats["timeouts"] += 1
+                raise PoolTimeout("数据库连接池已满，等待超时")
+            self._stats["wait_seconds"] += time.monotonic() - start
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        self._stats["acquired"] += 1
+        # 和 run() 一样，计时不含排队等连接的时间，包含提交
+        query_start = time.perf_counter()
+        try:
+            with conn:
+                yield conn
+        finally:
+            if name is not None:
+                db_query_seconds.observe(time.perf_counter() - query_start, name)
+            if conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._get_pool().putconn(conn)
+            self._slots.release()
+
+    def run(self, fn, *args, name=None):
+        # 计时不含排队等连接的时间（见 stats() 的 wait_seconds），包含提交；
+        # 默认按 fn 的函数名记，通用的 _fetchone 之类由调用方给出查询名
+        with self.connection(name or fn.__name__) as conn, conn.cursor() as c:
+            return fn(c, *args)
+
+    async def arun(self, fn, *args, name=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self.run, fn, *args, name=name))
+
+    async def fetchone(self, sql, params=None, *, name):
+        return await self.arun(_fetchone, sql, params, name=name)
+
+    async def fetchall(self, sql, params=None, *, name):
+        return await self.arun(_fetchall, sql, params, name=name)
+
+    async def execute(self, sql, params=None, *, name):
+        return await self.arun(_execute, sql, params, name=name)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["max_size"] = self.maxconn
+        stats["min_size"] = self.minconn
+        stats["idle"] = len(self._pool._pool) if self._pool else 0
+        stats["in_use"] = len(self._pool._used) if self._pool else 0
+        stats["open"] = stats["idle"] + stats["in_use"]
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._pool is not None:
+            self._pool.closeall()
+
+
+def _fetchone(c, sql, params):
+    c.execute(sql, params)
+    return c.fetchone()
+
+
+def _fetchall(c, sql, params):
+    c.execute(sql, params)
+    return c.fetchall()
+
+
+def _execute(c, sql, params):
+    c.execute(sql, params)
+    return c.rowcount
+
+
+db = DBPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_HEALTH_CHECK_INTERVAL)
+
+
+def get_conn(name=None):
+    """借用连接；给出 name 时，这段连接的占用时间按该名字记进 db_query_seconds。"""
+    return db.connection(name)
+
+
+class TTLCache:
+    """简单的进程内 TTL 缓存，超过 maxsize 时先清理过期项，再淘汰最早写入的项。"""
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            if self.maxsize is not None and len(self._data) > self.maxsize:
+                now = time.monotonic()
+                for k in [k for k, entry in self._data.items() if entry[0] < now]:
+                    del self._data[k]
+                while len(self._data) > self.maxsize:
+                    del self._data[next(iter(self._data))]
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def expire_older_than(self, seconds):
+        # 只丢弃写入时间超过 seconds 的项，频繁失效时仍能保留刚生成的缓存
+        cutoff = time.monotonic() + self.ttl - seconds
+        with self._lock:
+            for k in [k for k, entry in self._data.items() if entry[0] < cutoff]:
+                del self._data[k]
+
+
+RANK_SIZE = 10
+RANK_CACHE_TTL = float(os.getenv("RANK_CACHE_TTL", 5))
+
+
+class DailyLeaderboard:
+    """今日积分排行榜。
+
+    启动时从数据库加载今日玩家，之后在每局结算时增量更新，/rank 和 /rank_data
+    直接读内存中的前 N 名，不再扫描 users 表。跨天时自动清空。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.day = date.today()
+        self._players = {}
+        self._top = []
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.cache = TTLCache(RANK_CACHE_TTL)
+
+    def _roll_day(self):
+        today = date.today()
+        if self.day != today:
+            self.day = today
+            self._players.clear()
+            self._top = []
+            self._dirty = False
+            self.cache.invalidate()
+
+    def load(self, rows, replace=False):
+        with self._lock:
+            self._roll_day()
+            if replace:
+                self._players.clear()
+            for user_id, username, first_name, points in rows:
+                self._players[user_id] = (points, username, first_name)
+            self._dirty = True
+
+    def update(self, user_id, points, username, first_name):
+        with self._lock:
+            self._roll_day()
+            self._players[user_id] = (points, username, first_name)
+            # 只有可能影响前 N 名时才需要重新排序
+            if len(self._top) < self.size or points >= self._top[-1][2] or user_id in self._top_ids:
+                self._dirty = True
+
+    def set_points(self, user_id, points):
+        with self._lock:
+            entry = self._players.get(user_id)
+            if entry is not None:
+                self._players[user_id] = (points,) + entry[1:]
+                self._dirty = True
+                self.cache.invalidate()
+
+    def remove(self, user_id):
+        with self._lock:
+            if self._players.pop(user_id, None) is not None:
+                self._dirty = True
+                self.cache.invalidate()
+
+    @property
+    def _top_ids(self):
+        return {row[3] for row in self._top}
+
+    def top(self):
+        """返回 [(username, first_name, points, user_id), ...]"""
+        with self._lock:
+            self._roll_day()
+            if self._dirty:
+                ranked = heapq.nlargest(self.size, self._players.items(), key=lambda item: item[1][0])
+                self._top = [(username, first_name, points, user_id)
+                             for user_id, (points, username, first_name) in ranked]
+                self._dirty = False
+            return list(self._top)
+
+
+leaderboard = DailyLeaderboard(RANK_SIZE)
+
+
+def today_start():
+    return datetime.combine(date.today(), datetime.min.time()).astimezone()
+
+
+def _load_leaderboard(c):
+    c.execute("SELECT user_id, username, first_name, points FROM users WHERE last_play >= %s", (today_start(),))
+    return c.fetchall()
+
+
+def render_rank_message():
+    msg = leaderboard.cache.get("message")
+    if msg is not None:
+        return msg
+    rows = leaderboard.top()
+    if not rows:
+        return leaderboard.cache.set("message", "📬 今日暂无玩家积分记录")
+    msg = "📊 今日排行榜：\n"
+    medals = ["🥇", "🥈", "🥉"] + ["🎖"] * 7
+    for i, row in enumerate(rows):
+        name = row[0] or row[1] or "匿名"
+        msg += f"{medals[i]} {name[:4]}*** - {row[2]} 分\n"
+    return leaderboard.cache.set("message", msg)
+
+scheduler = AsyncIOScheduler()
 
 def init_db():
     with get_conn() as conn, conn.cursor() as c:
@@ -52,8 +497,8 @@ def init_db():
                 phone TEXT,
                 points INTEGER DEFAULT 0,
                 plays INTEGER DEFAULT 0,
-                created_at TEXT,
-                last_play TEXT,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                last_play TIMESTAMPTZ,
                 invited_by BIGINT,
                 is_blocked INTEGER DEFAULT 0
             );
@@ -89,6 +534,988 @@ def init_db():
             );
         ''')
         conn.commit()
+    run_migrations()
+
+# ---------- 数据库迁移 ----------
+# 每个迁移只执行一次，执行记录保存在 schema_migrations 表。
+# 迁移使用独立的 autocommit 连接：大表回填按批提交，索引用 CONCURRENTLY 创建，避免长时间锁表。
+
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 5000))
+MIGRATION_LOCK_ID = 727001
+MIGRATION_SKIPPED = object()
+# 交换表/列时最多等锁这么久；拿不到就回滚、稍后重试，不会排在长查询后面挡住写入
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", 10))
+# 旧版本写入的 TEXT 时间不带时区，按这个时区解释，不依赖数据库会话的 TimeZone 设置
+MIGRATION_SOURCE_TIMEZONE = os.getenv("MIGRATION_SOURCE_TIMEZONE", "UTC")
+# 邀请链超过这个层级（或存在互相邀请的环）时不再向上追溯
+INVITE_TREE_MAX_DEPTH = int(os.getenv("INVITE_TREE_MAX_DEPTH", 100))
+INVITE_CLOSURE_LOCK_ID = 727004
+
+
+@contextmanager
+def _transaction(conn):
+    conn.autocommit = False
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.autocommit = True
+
+
+def _swap_with_lock_timeout(conn, swap, label):
+    """在带 lock_timeout 的短事务里执行 swap(c)，等锁超时就重试；重试用完返回 False，下次启动再做。"""
+    for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+        try:
+            with _transaction(conn), conn.cursor() as c:
+                c.execute("SET LOCAL lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+                swap(c)
+            return True
+        except psycopg2.errors.LockNotAvailable:
+            logging.warning(f"⚠️ {label}等锁超时（第 {attempt} 次）")
+            time.sleep(min(30, 2 * attempt))
+    return False
+
+
+def _column_type(c, table, column):
+    c.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = %s AND column_name = %s
+    """, (table, column))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def _is_partitioned(c, table):
+    c.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = c.fetchone()
+    return bool(row and row[0])
+
+
+def _create_index_concurrently(c, name, ddl):
+    # 上次中断的 CONCURRENTLY 会留下 INVALID 索引，先清理再重建
+    c.execute("""
+        SELECT i.indisvalid FROM pg_class cl JOIN pg_index i ON i.indexrelid = cl.oid
+        WHERE cl.relname = %s
+    """, (name,))
+    row = c.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    logging.info(f"创建索引 {name}")
+    c.execute(ddl)
+
+
+def _backfill_in_batches(c, sql, label, params=None):
+    """
+    按 user_id 分批执行 sql，每批单独提交。sql 的参数为上一批最大 user_id、批大小；
+    给出 params（dict）时改用命名参数 %(last_id)s、%(batch_size)s，其余取自 params。
+    """
+    last_id, total = -1 << 63, 0
+    while True:
+        if params is None:
+            c.execute(sql, (last_id, MIGRATION_BATCH_SIZE))
+        else:
+            c.execute(sql, {**params, "last_id": last_id, "batch_size": MIGRATION_BATCH_SIZE})
+        ids = [row[0] for row in c.fetchall()]
+        if not ids:
+            break
+        last_id = max(ids)
+        total += len(ids)
+        logging.info(f"{label}：已处理 {total} 行")
+    return total
+
+
+def migrate_users_timestamps(conn):
+    with conn.cursor() as c:
+        if _column_type(c, "users", "created_at") == "timestamp with time zone":
+            return
+        c.execute("""
+            ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS created_at_tz TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS last_play_tz TIMESTAMPTZ
+        """)
+        # 回填期间旧版本进程仍在写旧列，用触发器同步到新列，交换时就不用再扫全表补齐
+        c.execute("""
+            CREATE OR REPLACE FUNCTION users_timestamps_sync() RETURNS trigger AS $$
+            BEGIN
+                NEW.created_at_tz := NULLIF(NEW.created_at, '')::timestamp AT TIME ZONE %(tz)s;
+                NEW.last_play_tz := NULLIF(NEW.last_play, '')::timestamp AT TIME ZONE %(tz)s;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """, {"tz": MIGRATION_SOURCE_TIMEZONE})
+        c.execute("DROP TRIGGER IF EXISTS users_timestamps_sync ON users")
+        c.execute("CREATE TRIGGER users_timestamps_sync BEFORE INSERT OR UPDATE ON users "
+                  "FOR EACH ROW EXECUTE FUNCTION users_timestamps_sync()")
+        # 上次交换等锁超时时回填已经做完，触发器一直在同步，重跑迁移不用再扫一遍
+        c.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM users
+                WHERE (created_at_tz IS NULL AND NULLIF(created_at, '') IS NOT NULL)
+                   OR (last_play_tz IS NULL AND NULLIF(last_play, '') IS NOT NULL)
+            )
+        """)
+        if c.fetchone()[0]:
+            _backfill_in_batches(c, """
+                WITH batch AS (
+                    SELECT user_id FROM users WHERE user_id > %(last_id)s ORDER BY user_id LIMIT %(batch_size)s
+                )
+                UPDATE users u
+                SET created_at_tz = NULLIF(u.created_at, '')::timestamp AT TIME ZONE %(tz)s,
+                    last_play_tz = NULLIF(u.last_play, '')::timestamp AT TIME ZONE %(tz)s
+                FROM batch WHERE u.user_id = batch.user_id
+                RETURNING u.user_id
+            """, "回填 users 时间字段", {"tz": MIGRATION_SOURCE_TIMEZONE})
+
+    def swap(c):
+        # 新列已由回填和触发器保持同步，这里只做短暂的交换
+        c.execute("DROP TRIGGER users_timestamps_sync ON users")
+        c.execute("DROP FUNCTION users_timestamps_sync()")
+        c.execute("ALTER TABLE users DROP COLUMN created_at, DROP COLUMN last_play")
+        c.execute("ALTER TABLE users RENAME COLUMN created_at_tz TO created_at")
+        c.execute("ALTER TABLE users RENAME COLUMN last_play_tz TO last_play")
+        c.execute("ALTER TABLE users ALTER COLUMN created_at SET DEFAULT NOW()")
+    # 交换没做成时触发器继续同步新列；下次启动重跑迁移时回填已经完成会被跳过，只需补做交换
+    return _swap_with_lock_timeout(conn, swap, "交换 users 时间字段")
+
+
+def migrate_indexes(conn):
+    with conn.cursor() as c:
+        _create_index_concurrently(c, "idx_users_invited_by",
+                                   "CREATE INDEX CONCURRENTLY idx_users_invited_by ON users (invited_by)")
+        _create_index_concurrently(c, "idx_users_phone",
+                                   "CREATE INDEX CONCURRENTLY idx_users_phone ON users (phone)")
+        _create_index_concurrently(c, "idx_users_last_play",
+                                   "CREATE INDEX CONCURRENTLY idx_users_last_play ON users (last_play)")
+        _create_index_concurrently(c, "idx_game_history_user_created",
+                                   "CREATE INDEX CONCURRENTLY idx_game_history_user_created "
+                                   "ON game_history (user_id, created_at DESC)")
+
+
+def migrate_invite_rewards_unique(conn):
+    with conn.cursor() as c:
+        c.execute("SELECT 1 FROM pg_constraint WHERE conname = 'uq_invite_rewards_pair'")
+        if c.fetchone():
+            return
+        with _transaction(conn):
+            # 合并重复记录：保留最早的一条，只要有一条已发放就视为已发放
+            c.execute("""
+                WITH ranked AS (
+                    SELECT id,
+                           row_number() OVER (PARTITION BY inviter, invitee ORDER BY id) AS rn,
+                           bool_or(reward_given) OVER (PARTITION BY inviter, invitee) AS given
+                    FROM invite_rewards
+                )
+                UPDATE invite_rewards r SET reward_given = TRUE
+                FROM ranked
+                WHERE r.id = ranked.id AND ranked.rn = 1 AND ranked.given AND r.reward_given IS NOT TRUE
+            """)
+            c.execute("""
+                DELETE FROM invite_rewards r
+                USING (
+                    SELECT id, row_number() OVER (PARTITION BY inviter, invitee ORDER BY id) AS rn
+                    FROM invite_rewards
+                ) ranked
+                WHERE r.id = ranked.id AND ranked.rn > 1
+            """)
+        _create_index_concurrently(c, "uq_invite_rewards_pair",
+                                   "CREATE UNIQUE INDEX CONCURRENTLY uq_invite_rewards_pair "
+                                   "ON invite_rewards (inviter, invitee)")
+        c.execute("""
+            ALTER TABLE invite_rewards
+            ADD CONSTRAINT uq_invite_rewards_pair UNIQUE USING INDEX uq_invite_rewards_pair
+        """)
+
+
+def migrate_trigram_indexes(conn):
+    with conn.cursor() as c:
+        try:
+            c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except psycopg2.errors.InsufficientPrivilege:
+            logging.warning("没有权限创建 pg_trgm 扩展，暂不创建模糊搜索索引，下次启动时重试")
+            return MIGRATION_SKIPPED
+        _create_index_concurrently(c, "idx_users_username_trgm",
+                                   "CREATE INDEX CONCURRENTLY idx_users_username_trgm "
+                                   "ON users USING gin (username gin_trgm_ops)")
+        _create_index_concurrently(c, "idx_users_phone_trgm",
+                                   "CREATE INDEX CONCURRENTLY idx_users_phone_trgm "
+                                   "ON users USING gin (phone gin_trgm_ops)")
+
+
+def migrate_keyset_indexes(conn):
+    with conn.cursor() as c:
+        # 游标分页要求 created_at 非空：历史空值回填为 epoch，再用 NOT VALID + VALIDATE 在线加约束
+        _backfill_in_batches(c, """
+            WITH batch AS (
+                SELECT user_id FROM users
+                WHERE user_id > %s AND created_at IS NULL
+                ORDER BY user_id LIMIT %s
+            )
+            UPDATE users u SET created_at = 'epoch'
+            FROM batch WHERE u.user_id = batch.user_id
+            RETURNING u.user_id
+        """, "回填空的 users.created_at")
+        c.execute("SELECT 1 FROM pg_constraint WHERE conname = 'users_created_at_not_null'")
+        if not c.fetchone():
+            c.execute("""
+                ALTER TABLE users ADD CONSTRAINT users_created_at_not_null
+                CHECK (created_at IS NOT NULL) NOT VALID
+            """)
+        c.execute("ALTER TABLE users VALIDATE CONSTRAINT users_created_at_not_null")
+        c.execute("ALTER TABLE users ALTER COLUMN created_at SET NOT NULL")
+        c.execute("ALTER TABLE users DROP CONSTRAINT users_created_at_not_null")
+        _create_index_concurrently(c, "idx_users_created_id",
+                                   "CREATE INDEX CONCURRENTLY idx_users_created_id "
+                                   "ON users (created_at DESC, user_id DESC)")
+        _create_index_concurrently(c, "idx_game_history_created_id",
+                                   "CREATE INDEX CONCURRENTLY idx_game_history_created_id "
+                                   "ON game_history (created_at DESC, id DESC)")
+
+
+def migrate_reset_index(conn):
+    with conn.cursor() as c:
+        _create_index_concurrently(c, "idx_users_plays_positive",
+                                   "CREATE INDEX CONCURRENTLY idx_users_plays_positive "
+                                   "ON users (user_id) WHERE plays > 0")
+
+
+def migrate_invitee_index(conn):
+    # 批量删除用户时按 invitee 清理 invite_rewards；(inviter, invitee) 唯一索引只覆盖 inviter
+    with conn.cursor() as c:
+        _create_index_concurrently(c, "idx_invite_rewards_invitee",
+                                   "CREATE INDEX CONCURRENTLY idx_invite_rewards_invitee "
+                                   "ON invite_rewards (invitee)")
+
+
+def migrate_game_claim(conn):
+    # 可空列、无默认值，只改元数据，不重写表
+    with conn.cursor() as c:
+        c.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS game_started_at TIMESTAMPTZ")
+
+
+def migrate_invite_closure(conn):
+    with conn.cursor() as c:
+        # 每个 (下级, 上级) 一行，depth=1 为直接邀请；主键顺序服务于查上级链和新用户入库时的连接
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS invite_closure (
+                descendant BIGINT NOT NULL,
+                ancestor BIGINT NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (descendant, ancestor)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_invite_closure_ancestor "
+                  "ON invite_closure (ancestor, depth, descendant)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS invite_stats (
+                user_id BIGINT PRIMARY KEY,
+                direct INTEGER NOT NULL DEFAULT 0,
+                downline INTEGER NOT NULL DEFAULT 0,
+                max_depth INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_invite_stats_downline ON invite_stats (downline DESC, user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_invite_stats_direct ON invite_stats (direct DESC, user_id)")
+        # 按批沿 invited_by 向上走，生成每个已有用户的全部上级
+        _backfill_in_batches(c, f"""
+            WITH RECURSIVE batch AS (
+                SELECT user_id, invited_by FROM users
+                WHERE user_id > %s AND invited_by IS NOT NULL
+                ORDER BY user_id LIMIT %s
+            ), chain (descendant, ancestor, depth) AS (
+                SELECT user_id, invited_by, 1 FROM batch WHERE invited_by <> user_id
+                UNION ALL
+                SELECT ch.descendant, u.invited_by, ch.depth + 1
+                FROM chain ch JOIN users u ON u.user_id = ch.ancestor
+                WHERE u.invited_by IS NOT NULL AND u.invited_by <> ch.descendant
+                  AND ch.depth < {INVITE_TREE_MAX_DEPTH}
+            ), ins AS (
+                INSERT INTO invite_closure (descendant, ancestor, depth)
+                SELECT descendant, ancestor, MIN(depth) FROM chain GROUP BY descendant, ancestor
+                ON CONFLICT DO NOTHING
+            )
+            SELECT user_id FROM batch
+        """, "生成邀请关系闭包")
+        with _transaction(conn):
+            c.execute("TRUNCATE invite_stats")
+            c.execute("""
+                INSERT INTO invite_stats (user_id, direct, downline, max_depth)
+                SELECT ancestor, COUNT(*) FILTER (WHERE depth = 1), COUNT(*), MAX(depth)
+                FROM invite_closure GROUP BY ancestor
+            """)
+
+
+def migrate_game_rollups(conn):
+    with conn.cursor() as c:
+        # grain 为 hour / day，bucket 是本地时间截断后的起点，和 game_history.created_at 一致
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS game_rollups (
+                grain TEXT NOT NULL,
+                bucket TIMESTAMP NOT NULL,
+                games INTEGER NOT NULL DEFAULT 0,
+                wins INTEGER NOT NULL DEFAULT 0,
+                losses INTEGER NOT NULL DEFAULT 0,
+                ties INTEGER NOT NULL DEFAULT 0,
+                points BIGINT NOT NULL DEFAULT 0,
+                players INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (grain, bucket)
+            )
+        """)
+        # 每个桶里出现过的玩家，用来增量计算去重人数；桶结束后由汇总任务清理
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS game_rollup_players (
+                grain TEXT NOT NULL,
+                bucket TIMESTAMP NOT NULL,
+                user_id BIGINT NOT NULL,
+                PRIMARY KEY (grain, bucket, user_id)
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_id BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("INSERT INTO rollup_state (name) VALUES ('game_history') ON CONFLICT DO NOTHING")
+
+
+def migrate_partition_game_history(conn):
+    """把 game_history 换成按月分区的表。
+
+    先建好分区表，用触发器把旧表上的新增 / 删除同步过去，再按 id 分批搬运旧数据，
+    最后在一个短事务里互换表名；整个过程中读写都照常走旧表。
+    """
+    with conn.cursor() as c:
+        if _is_partitioned(c, "game_history"):
+            return
+        c.execute("SELECT pg_get_serial_sequence('game_history', 'id')")
+        seq = c.fetchone()[0]
+        c.execute(f"ALTER SEQUENCE {seq} AS BIGINT")
+        # 分区表的主键必须包含分区键
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS game_history_partitioned (
+                id BIGINT NOT NULL DEFAULT nextval('{seq}'),
+                user_id BIGINT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                user_score INTEGER,
+                bot_score INTEGER,
+                result TEXT,
+                points_change INTEGER,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        # 已有数据涉及的月份：沿 created_at 索引跳着找，不扫全表
+        c.execute("""
+            WITH RECURSIVE months (month) AS (
+                SELECT date_trunc('month', MIN(created_at)) FROM game_history
+                UNION ALL
+                SELECT (SELECT date_trunc('month', MIN(created_at)) FROM game_history
+                        WHERE created_at >= m.month + INTERVAL '1 month')
+                FROM months m WHERE m.month IS NOT NULL
+            )
+            SELECT month FROM months WHERE month IS NOT NULL
+        """)
+        for (month,) in c.fetchall():
+            _create_history_partition(c, month, "game_history_partitioned")
+        _ensure_history_partitions(c, datetime.now(), "game_history_partitioned")
+        # 在父表上建索引，现有和以后新建的分区都会自动带上
+        c.execute("CREATE INDEX IF NOT EXISTS idx_game_history_partitioned_user_created "
+                  "ON game_history_partitioned (user_id, created_at DESC, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_game_history_partitioned_created_id "
+                  "ON game_history_partitioned (created_at DESC, id DESC)")
+
+        c.execute("""
+            CREATE OR REPLACE FUNCTION game_history_mirror() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                    DELETE FROM game_history_partitioned WHERE id = OLD.id AND created_at = OLD.created_at;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO game_history_partitioned
+                        (id, user_id, created_at, user_score, bot_score, result, points_change)
+                    VALUES (NEW.id, NEW.user_id, NEW.created_at, NEW.user_score, NEW.bot_score,
+                            NEW.result, NEW.points_change)
+                    ON CONFLICT DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        c.execute("DROP TRIGGER IF EXISTS game_history_mirror ON game_history")
+        c.execute("CREATE TRIGGER game_history_mirror AFTER INSERT OR UPDATE OR DELETE ON game_history "
+                  "FOR EACH ROW EXECUTE FUNCTION game_history_mirror()")
+        # FOR SHARE：正在搬运的行不会被并发删除，已删除的行也不会被搬过去
+        _backfill_in_batches(c, """
+            WITH batch AS (
+                SELECT id, user_id, created_at, user_score, bot_score, result, points_change
+                FROM game_history
+                WHERE id > %s ORDER BY id LIMIT %s
+                FOR SHARE
+            ), ins AS (
+                INSERT INTO game_history_partitioned
+                    (id, user_id, created_at, user_score, bot_score, result, points_change)
+                SELECT * FROM batch
+                ON CONFLICT DO NOTHING
+            )
+            SELECT id FROM batch
+        """, "迁移游戏记录到分区表")
+
+        def swap(c):
+            c.execute("LOCK TABLE game_history IN ACCESS EXCLUSIVE MODE")
+            c.execute("DROP TRIGGER game_history_mirror ON game_history")
+            c.execute("DROP FUNCTION game_history_mirror()")
+            c.execute(f"ALTER SEQUENCE {seq} OWNED BY NONE")
+            c.execute("ALTER TABLE game_history RENAME TO game_history_legacy")
+            c.execute("ALTER TABLE game_history_partitioned RENAME TO game_history")
+            c.execute(f"ALTER SEQUENCE {seq} OWNED BY game_history.id")
+        # 没换成时镜像触发器继续同步，下次启动重跑迁移时回填只会跳过已有的行
+        if not _swap_with_lock_timeout(conn, swap, "切换 game_history 分区表"):
+            return False
+        c.execute("DROP TABLE game_history_legacy")
+        c.execute("ALTER TABLE game_history RENAME CONSTRAINT game_history_partitioned_pkey TO game_history_pkey")
+        c.execute("ALTER INDEX idx_game_history_partitioned_user_created RENAME TO idx_game_history_user_created")
+        c.execute("ALTER INDEX idx_game_history_partitioned_created_id RENAME TO idx_game_history_created_id")
+
+
+MIGRATIONS = [
+    (1, "users.created_at / last_play 改为 TIMESTAMPTZ", migrate_users_timestamps),
+    (2, "常用查询索引", migrate_indexes),
+    (3, "invite_rewards (inviter, invitee) 唯一约束", migrate_invite_rewards_unique),
+    (4, "模糊搜索 trigram 索引", migrate_trigram_indexes),
+    (5, "游标分页索引", migrate_keyset_indexes),
+    (6, "每日重置用的部分索引", migrate_reset_index),
+    (7, "invite_rewards.invitee 索引", migrate_invitee_index),
+    (8, "users.game_started_at 对局占用标记", migrate_game_claim),
+    (9, "邀请关系闭包表", migrate_invite_closure),
+    (10, "游戏记录按小时 / 按天汇总", migrate_game_rollups),
+    (11, "game_history 按月分区", migrate_partition_game_history),
+]
+
+
+def run_migrations():
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as c:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT,
+                    applied_at TIMESTAMPTZ DEFAULT NOW()
+                )
+            """)
+            # 多个实例同时启动时只允许一个执行迁移
+            c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                c.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in c.fetchall()}
+                for version, name, migrate in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    logging.info(f"🛠 执行数据库迁移 {version}: {name}")
+                    start = time.monotonic()
+                    result = migrate(conn)
+                    # MIGRATION_SKIPPED：条件不满足（如缺少权限），后续迁移不依赖它，不记录，下次启动时重试
+                    if result is MIGRATION_SKIPPED:
+                        continue
+                    # False：没有做完（如等锁超时），后续迁移可能依赖它的结果，本次到此为止，下次启动从这里继续
+                    if result is False:
+                        logging.warning(f"⚠️ 迁移 {version} 未完成，后续迁移推迟到下次启动")
+                        break
+                    c.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    logging.info(f"✅ 迁移 {version} 完成，用时 {time.monotonic() - start:.1f}s")
+                # 持有迁移锁时预建分区，多个实例同时启动也不会抢着建同一个
+                if _is_partitioned(c, "game_history"):
+                    _ensure_history_partitions(c, datetime.now())
+            finally:
+                c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.close()
+
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", 60))
+count_cache = TTLCache(COUNT_CACHE_TTL)
+
+
+def encode_cursor(created_at, row_id):
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        return None
+
+
+def keyset_paginate(c, sql, conditions, params, key, after, before, per_page):
+    """按 (时间, id) 倒序做游标分页，sql 中需包含 {where} 和 {order} 占位。
+
+    after 取更旧的一页，before 取更新的一页。返回 (rows, has_prev, has_next)。
+    """
+    conditions = list(conditions)
+    params = list(params)
+    cursor = decode_cursor(after or before)
+    backwards = bool(before) and cursor is not None and not after
+    if cursor:
+        conditions.append(f"({key[0]}, {key[1]}) {'>' if backwards else '<'} (%s, %s)")
+        params.extend(cursor)
+        # 等价的单列条件，分区表据此在规划时排除不相关的分区
+        conditions.append(f"{key[0]} {'>=' if backwards else '<='} %s")
+        params.append(cursor[0])
+    direction = "ASC" if backwards else "DESC"
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    order_sql = f"{key[0]} {direction}, {key[1]} {direction}"
+    c.execute(sql.format(where=where_sql, order=order_sql) + " LIMIT %s", params + [per_page + 1])
+    rows = c.fetchall()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor is not None, more
+
+
+def estimate_count(c, table, count_sql, params):
+    """返回 (总数, 是否为估算值)。
+
+    无过滤条件时直接读 pg_class.reltuples（分区表按各分区相加），有过滤条件时执行 count_sql
+    并缓存 COUNT_CACHE_TTL 秒。
+    """
+    if count_sql is None:
+        # 从未 ANALYZE 过的分区 reltuples 为 -1，不计入
+        c.execute("""
+            SELECT SUM(cls.reltuples) FILTER (WHERE cls.reltuples >= 0)::bigint
+            FROM pg_partition_tree(%s::regclass) t
+            JOIN pg_class cls ON cls.oid = t.relid
+            WHERE t.isleaf
+        """, (table,))
+        row = c.fetchone()
+        if row and row[0] is not None:
+            return row[0], True
+        count_sql = f"SELECT COUNT(*) FROM {table}"
+    cache_key = (count_sql, tuple(params))
+    total = count_cache.get(cache_key)
+    if total is None:
+        c.execute(count_sql, params)
+        total = count_cache.set(cache_key, c.fetchone()[0])
+    return total, False
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 5))
+# 游戏结算时只失效已存在超过该秒数的页面缓存，避免高峰期缓存完全失效
+RESPONSE_CACHE_MIN_AGE = float(os.getenv("RESPONSE_CACHE_MIN_AGE", 1))
+GZIP_MIN_SIZE = 1024
+response_cache = TTLCache(RESPONSE_CACHE_TTL, maxsize=1000)
+
+
+def cached_response(func):
+    """按 路由 + 查询参数 缓存响应内容，并支持 ETag / If-None-Match 和 gzip。"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = response_cache.get(key)
+        if entry is None:
+            resp = make_response(func(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            body = resp.get_data()
+            gzipped = gzip.compress(body) if len(body) >= GZIP_MIN_SIZE else None
+            entry = response_cache.set(key, (body, gzipped, hashlib.sha1(body).hexdigest(), resp.content_type))
+        body, gzipped, etag, content_type = entry
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        elif gzipped is not None and "gzip" in request.accept_encodings:
+            resp = Response(gzipped, content_type=content_type)
+            resp.headers["Content-Encoding"] = "gzip"
+        else:
+            resp = Response(body, content_type=content_type)
+        resp.set_etag(etag)
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+    return wrapper
+
+
+# ---------- 多实例协调 ----------
+# 多个机器人 / 后台实例共用一个数据库时：
+# - 定时任务只在持有 advisory 锁的 leader 上执行（锁挂在 LISTEN 连接上，实例退出或断线即释放）；
+# - 内存缓存（用户门槛状态、排行榜、后台统计和响应缓存）的变更通过 emit() 先在本地生效，
+#   再经 NOTIFY 广播，其他实例收到后做同样的处理。
+# 单实例部署保持 COORDINATION_ENABLED=0，本实例始终是 leader，emit() 只在本地生效。
+
+COORDINATION_ENABLED = os.getenv("COORDINATION_ENABLED", "0") == "1"
+COORDINATION_RETRY_SECONDS = float(os.getenv("COORDINATION_RETRY_SECONDS", 10))
+# LISTEN 连接上的语句超时与 TCP keepalive：数据库变慢或网络分区时尽快断开重连，而不是一直挂着
+COORDINATION_STATEMENT_TIMEOUT_MS = int(os.getenv("COORDINATION_STATEMENT_TIMEOUT_MS", 5000))
+COORDINATION_CONNECT_ARGS = {
+    "connect_timeout": 10,
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+    "options": f"-c statement_timeout={COORDINATION_STATEMENT_TIMEOUT_MS}",
+}
+COORDINATION_CHANNEL = "dice_bot_events"
+LEADER_LOCK_ID = 727002
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+# NOTIFY 的消息体上限约 8000 字节，列表按块拆成多条
+EVENT_CHUNK_SIZE = 200
+
+
+def _notify_events(c, payloads):
+    c.execute("SELECT pg_notify(%s, p) FROM unnest(%s::text[]) p", (COORDINATION_CHANNEL, payloads))
+
+
+class Coordinator:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.is_leader = not enabled
+        self.handlers = {}
+        self._outgoing = []
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread = None
+        self._wake = None
+        self._stats = Counter()
+
+    def on(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def emit(self, kind, items=None, **data):
+        """本地执行 kind 对应的处理，并广播给其他实例。items 列表过长时按块拆分。"""
+        self._apply(kind, items, data)
+        if not self.enabled:
+            return
+        chunks = [items[i:i + EVENT_CHUNK_SIZE] for i in range(0, len(items), EVENT_CHUNK_SIZE)] if items else [items]
+        payloads = [json.dumps({"origin": INSTANCE_ID, "kind": kind, "items": chunk, **data}) for chunk in chunks]
+        if self._loop is not None and threading.get_ident() == self._loop_thread:
+            # 事件循环里（handler、定时任务）攒起来由 _flush 批量发送
+            with self._lock:
+                self._outgoing.extend(payloads)
+            self._wake.set()
+            return
+        # Flask 线程或独立后台进程：直接发送
+        try:
+            db.run(_notify_events, payloads)
+            self._stats["sent"] += len(payloads)
+        except Exception as e:
+            self._stats["send_errors"] += 1
+            logging.error(f"广播 {kind} 事件失败: {e}")
+
+    def _apply(self, kind, items, data):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            logging.warning(f"未知的协调事件: {kind}")
+            return
+        handler(items, **data)
+
+    def _receive(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.pop("origin", None) == INSTANCE_ID:
+            return
+        self._stats["received"] += 1
+        try:
+            self._apply(event.pop("kind"), event.pop("items", None), event)
+        except Exception as e:
+            logging.error(f"处理协调事件失败: {e}")
+
+    async def _flush(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                payloads, self._outgoing = self._outgoing, []
+            if not payloads:
+                continue
+            try:
+                await db.arun(_notify_events, payloads)
+                self._stats["sent"] += len(payloads)
+            except Exception as e:
+                self._stats["send_errors"] += 1
+                logging.error(f"广播协调事件失败: {e}")
+
+    def _try_lead(self, conn):
+        with conn.cursor() as c:
+            c.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_ID,))
+            return c.fetchone()[0]
+
+    @staticmethod
+    def _execute(conn, sql):
+        with conn.cursor() as c:
+            c.execute(sql)
+
+    async def _listen(self, lead):
+        # 这条连接上的同步调用都放到线程池里执行，数据库卡住时不会冻结事件循环
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(None, partial(psycopg2.connect, DATABASE_URL, **COORDINATION_CONNECT_ARGS))
+        conn.autocommit = True
+        readable = asyncio.Event()
+        try:
+            await loop.run_in_executor(None, self._execute, conn, f"LISTEN {COORDINATION_CHANNEL}")
+            loop.add_reader(conn.fileno(), readable.set)
+            try:
+                while True:
+                    if self.is_leader:
+                        # 空闲时探测一下连接，断线意味着锁已丢失
+                        await loop.run_in_executor(None, self._execute, conn, "SELECT 1")
+                    elif lead and await loop.run_in_executor(None, self._try_lead, conn):
+                        self.is_leader = True
+                        self._stats["elections_won"] += 1
+                        logging.info(f"👑 {INSTANCE_ID} 成为 leader，负责执行定时任务")
+                    try:
+                        await asyncio.wait_for(readable.wait(), COORDINATION_RETRY_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    readable.clear()
+                    conn.poll()
+                    while conn.notifies:
+                        self._receive(conn.notifies.pop(0).payload)
+            finally:
+                loop.remove_reader(conn.fileno())
+        finally:
+            conn.close()
+
+    async def run(self, lead=True):
+        """lead=False 时只收发事件，不参与 leader 选举（独立后台进程）。"""
+        if not self.enabled:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wake = asyncio.Event()
+        flush_task = asyncio.create_task(self._flush())
+        try:
+            while True:
+                try:
+                    await self._listen(lead)
+                except Exception as e:
+                    logging.error(f"协调连接断开: {e}")
+                if self.is_leader:
+                    logging.warning(f"{INSTANCE_ID} 失去 leader 身份")
+                self.is_leader = False
+                await asyncio.sleep(COORDINATION_RETRY_SECONDS)
+        finally:
+            flush_task.cancel()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update(enabled=self.enabled, instance=INSTANCE_ID, leader=self.is_leader,
+                     pending=len(self._outgoing))
+        return stats
+
+
+coordinator = Coordinator(COORDINATION_ENABLED)
+
+
+def leader_only(job):
+    """定时任务只在 leader 实例上执行。"""
+    @wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not coordinator.is_leader:
+            logging.debug(f"非 leader 实例，跳过定时任务 {job.__name__}")
+            return
+        return await job(*args, **kwargs)
+    return wrapper
+
+
+@coordinator.on("admin")
+def _on_admin_change(user_ids, is_blocked=None):
+    stats_cache.invalidate()
+    response_cache.invalidate()
+    for user_id in user_ids or ():
+        user_states.invalidate(user_id)
+    if is_blocked is not None:
+        live_events.publish("blocked", {"user_ids": user_ids, "is_blocked": is_blocked})
+
+
+@coordinator.on("users")
+def _on_users_changed(user_ids):
+    for user_id in user_ids:
+        user_states.invalidate(user_id)
+
+
+@coordinator.on("joined")
+def _on_users_joined(users):
+    live_events.publish("joined", [{"user_id": user_id, "invited_by": invited_by} for user_id, invited_by in users])
+
+
+@coordinator.on("reset")
+def _on_daily_reset(_):
+    user_states.clear()
+    publish_leaderboard()
+
+
+@coordinator.on("settle")
+def _on_settle(_, user_id, points, username, first_name, change=None):
+    leaderboard.update(user_id, points, username, first_name)
+    response_cache.expire_older_than(RESPONSE_CACHE_MIN_AGE)
+    live_events.publish("game", {"user_id": user_id, "username": username, "first_name": first_name,
+                                 "points": points, "change": change})
+    publish_leaderboard()
+
+
+@coordinator.on("points")
+def _on_points_changed(entries):
+    for user_id, points in entries:
+        leaderboard.set_points(user_id, points)
+    live_events.publish("points", entries)
+    publish_leaderboard()
+
+
+@coordinator.on("removed")
+def _on_users_removed(user_ids):
+    for user_id in user_ids:
+        leaderboard.remove(user_id)
+    live_events.publish("removed", user_ids)
+    publish_leaderboard()
+
+
+def invalidate_admin_caches(*user_ids, **changes):
+    coordinator.emit("admin", list(user_ids), **changes)
+
+# ---------- 实时推送 ----------
+# 后台页面通过 SSE（/events）接收结算、排行榜、新用户和封禁变更。事件来自上面的协调事件处理，
+# 所以其他实例上发生的变化也会推送过来；每个事件只编码一次，分发给所有连接，不按连接查库。
+
+LIVE_PATH = "/events"
+LIVE_MAX_CLIENTS = int(os.getenv("LIVE_MAX_CLIENTS", 500))
+# 每个连接最多积压的事件数，超过说明客户端跟不上，直接断开让浏览器重连
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 256))
+LIVE_HEARTBEAT_SECONDS = float(os.getenv("LIVE_HEARTBEAT_SECONDS", 15))
+LIVE_RETRY_MS = 3000
+
+
+class EventBus:
+    """进程内事件总线。publish() 可以在任意线程调用，订阅者是事件循环里的 asyncio.Queue。"""
+
+    def __init__(self, max_subscribers, queue_size):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._loop = None
+        self._stats = Counter()
+
+    def subscribe(self):
+        if len(self._subscribers) >= self.max_subscribers:
+            self._stats["rejected"] += 1
+            return None
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        self._stats["subscribed"] += 1
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    @property
+    def active(self):
+        return bool(self._subscribers)
+
+    def publish(self, kind, data):
+        # 没有页面在看时什么都不做，结算路径上没有额外开销
+        if not self._subscribers:
+            return
+        message = f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode()
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._fanout(message)
+        else:
+            self._loop.call_soon_threadsafe(self._fanout, message)
+
+    def _fanout(self, message):
+        self._stats["published"] += 1
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 腾出一个位置放结束标记，连接随后关闭
+                self._subscribers.discard(queue)
+                self._stats["dropped"] += 1
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["subscribers"] = len(self._subscribers)
+        return stats
+
+
+live_events = EventBus(LIVE_MAX_CLIENTS, LIVE_QUEUE_SIZE)
+_live_top = None
+
+
+def publish_leaderboard():
+    """前 N 名有变化时推送完整榜单（最多 RANK_SIZE 条），格式和 /rank_data 相同。"""
+    global _live_top
+    if not leaderboard_live or not live_events.active:
+        return
+    top = [{"username": r[0], "first_name": r[1], "points": r[2]} for r in leaderboard.top()]
+    if top != _live_top:
+        _live_top = top
+        live_events.publish("leaderboard", top)
+
+
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 10))
+stats_cache = TTLCache(STATS_CACHE_TTL)
+
+
+def page_invite_counts(c, user_ids):
+    if not user_ids:
+        return {}
+    c.execute("""
+        SELECT invited_by, COUNT(*) FROM users
+        WHERE invited_by = ANY(%s)
+        GROUP BY invited_by
+    """, (user_ids,))
+    return dict(c.fetchall())
+
+
+def _query_dashboard_totals(c):
+    c.execute("""
+        SELECT COUNT(*),
+               COUNT(*) FILTER (WHERE phone IS NOT NULL),
+               COUNT(*) FILTER (WHERE is_blocked = 1),
+               COALESCE(SUM(points), 0)
+        FROM users
+    """)
+    return stats_cache.set("totals", c.fetchone())
+
+
+def dashboard_totals(c):
+    totals = stats_cache.get("totals")
+    if totals is None:
+        totals = _query_dashboard_totals(c)
+    return totals
+
+def user_filters(keyword, authorized):
+    """仪表盘和导出共用的用户筛选条件（u 为用户表，i 为邀请人）"""
+    conditions = []
+    params = []
+
+    if keyword:
+        conditions.append("(u.username ILIKE %s OR u.phone ILIKE %s OR i.username ILIKE %s)")
+        params.extend([f"%{keyword}%", f"%{keyword}%", f"%{keyword}%"])
+
+    if authorized == '1':
+        conditions.append("u.phone IS NOT NULL")
+    elif authorized == '0':
+        conditions.append("u.phone IS NULL")
+
+    return conditions, params
 
 @app.route("/")
 @app.route("/")
@@ -97,87 +1524,71 @@ def init_db():
 @app.route("/")
 
 @app.route("/")
+@cached_response
 def dashboard():
     try:
         keyword = request.args.get("keyword", "").strip()
         authorized = request.args.get("authorized", "").strip()
-        page = int(request.args.get("page", 1))
+        after = request.args.get("after")
+        before = request.args.get("before")
         per_page = 20
-        offset = (page - 1) * per_page
-
-        conditions = []
-        params = []
-
-        if keyword:
-            conditions.append("(u.username ILIKE %s OR u.phone ILIKE %s OR i.username ILIKE %s)")
-            params.extend([f"%{keyword}%", f"%{keyword}%", f"%{keyword}%"])
-
-        if authorized == '1':
-            conditions.append("u.phone IS NOT NULL")
-        elif authorized == '0':
-            conditions.append("u.phone IS NULL")
 
+        conditions, params = user_filters(keyword, authorized)
         where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
 
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute(f"""
+        with get_conn("dashboard") as conn, conn.cursor() as c:
+            total_count, count_is_estimate = estimate_count(c, "users", f"""
                 SELECT COUNT(*)
                 FROM users u
                 LEFT JOIN users i ON u.invited_by = i.user_id
                 {where_sql}
-            """, params)
-            total_count = c.fetchone()[0]
+            """ if conditions else None, params)
 
-            c.execute(f"""
+            users, has_prev, has_next = keyset_paginate(c, """
                 SELECT u.user_id, u.first_name, u.last_name, u.username, u.phone, u.points, u.plays,
                        u.created_at, u.last_play, u.invited_by, u.is_blocked,
-                       i.username AS inviter_username,
-                       COALESCE((SELECT COUNT(*) FROM users u2 WHERE u2.invited_by = u.user_id), 0) AS invite_count
+                       i.username AS inviter_username
                 FROM users u
                 LEFT JOIN users i ON u.invited_by = i.user_id
-                {where_sql}
-                ORDER BY u.created_at DESC
-                LIMIT %s OFFSET %s
-            """, params + [per_page, offset])
-            users = c.fetchall()
+                {where}
+                ORDER BY {order}
+            """, conditions, params, ("u.created_at", "u.user_id"), after, before, per_page)
 
-            # 统计信息
-            c.execute("SELECT COUNT(*) FROM users")
-            total_users = c.fetchone()[0]
-            c.execute("SELECT COUNT(*) FROM users WHERE phone IS NOT NULL")
-            authorized_users = c.fetchone()[0]
-            c.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
-            blocked_users = c.fetchone()[0]
-            c.execute("SELECT COALESCE(SUM(points), 0) FROM users")
-            total_points = c.fetchone()[0]
+            # 当前页用户的邀请人数，一次分组查询算出
+            invite_counts = page_invite_counts(c, [u[0] for u in users])
+            users = [u + (invite_counts.get(u[0], 0),) for u in users]
 
-        total_pages = (total_count + per_page - 1) // per_page
+            # 统计信息
+            total_users, authorized_users, blocked_users, total_points = dashboard_totals(c)
 
         stats = {
             "total_users": total_users,
             "authorized_users": authorized_users,
             "blocked_users": blocked_users,
             "total_points": total_points,
-            "page": page,
-            "total_pages": total_pages
+            "total_count": total_count,
+            "count_is_estimate": count_is_estimate
         }
 
         return render_template("dashboard.html",
                                users=users,
                                stats=stats,
                                keyword=keyword,
-                               is_authorized=authorized)
+                               is_authorized=authorized,
+                               prev_cursor=encode_cursor(users[0][7], users[0][0]) if has_prev and users else None,
+                               next_cursor=encode_cursor(users[-1][7], users[-1][0]) if has_next and users else None)
     except Exception as e:
         import traceback
-        return f"<pre>出错了：\n{traceback.format_exc()}</pre>"
+        return f"<pre>出错了：\n{traceback.format_exc()}</pre>", 500
 
 @app.route("/invitees")
+@cached_response
 def invitees():
-    inviter_id = request.args.get("user_id")
-    if not inviter_id:
-        return "缺少邀请人 user_id 参数", 400
+    inviter_id = request.args.get("user_id", type=int)
+    if inviter_id is None:
+        return "缺少或无效的邀请人 user_id 参数", 400
 
-    with get_conn() as conn, conn.cursor() as c:
+    with get_conn("invitees") as conn, conn.cursor() as c:
         c.execute("""
             SELECT user_id, username, phone, points, created_at
             FROM users WHERE invited_by = %s
@@ -196,15 +1607,122 @@ def invitees():
                            inviter_id=inviter_id)
         
     
+# ---------- 邀请关系树 ----------
+# 基于 invite_closure / invite_stats，团队人数和排行直接读预先维护的计数，不做递归查询。
+
+INVITE_TREE_PAGE_MAX = 1000
+
+
+@app.route("/invite_tree/top")
+@cached_response
+def invite_tree_top():
+    by = request.args.get("by", "downline")
+    if by not in ("downline", "direct"):
+        return jsonify({"error": "by 只支持 downline 或 direct"}), 400
+    limit = max(1, min(request.args.get("limit", 20, type=int), INVITE_TREE_PAGE_MAX))
+    with get_conn("invite_tree_top") as conn, conn.cursor() as c:
+        c.execute(f"""
+            SELECT s.user_id, u.username, u.first_name, s.direct, s.downline, s.max_depth
+            FROM invite_stats s
+            LEFT JOIN users u ON u.user_id = s.user_id
+            ORDER BY s.{by} DESC, s.user_id
+            LIMIT %s
+        """, (limit,))
+        rows = c.fetchall()
+    return jsonify([
+        {"user_id": r[0], "username": r[1], "first_name": r[2], "direct": r[3], "downline": r[4], "max_depth": r[5]}
+        for r in rows
+    ])
+
+
+@app.route("/invite_tree/<int:user_id>")
+@cached_response
+def invite_tree_summary(user_id):
+    with get_conn("invite_tree_summary") as conn, conn.cursor() as c:
+        c.execute("SELECT direct, downline, max_depth FROM invite_stats WHERE user_id = %s", (user_id,))
+        direct, downline, max_depth = c.fetchone() or (0, 0, 0)
+        c.execute("""
+            SELECT c.ancestor, c.depth, u.username
+            FROM invite_closure c
+            LEFT JOIN users u ON u.user_id = c.ancestor
+            WHERE c.descendant = %s
+            ORDER BY c.depth
+        """, (user_id,))
+        upline = [{"user_id": r[0], "depth": r[1], "username": r[2]} for r in c.fetchall()]
+        # 各层人数，走 (ancestor, depth, descendant) 索引的 index-only scan
+        c.execute("""
+            SELECT depth, COUNT(*) FROM invite_closure
+            WHERE ancestor = %s GROUP BY depth ORDER BY depth
+        """, (user_id,))
+        levels = [{"depth": r[0], "count": r[1]} for r in c.fetchall()]
+    return jsonify({
+        "user_id": user_id,
+        "direct": direct,
+        "downline": downline,
+        "max_depth": max_depth,
+        "upline": upline,
+        "levels": levels,
+    })
+
+
+@app.route("/invite_tree/<int:user_id>/subtree")
+@cached_response
+def invite_subtree(user_id):
+    """按 (层级, user_id) 游标分页列出下级，after 为上一页返回的 next。"""
+    per_page = max(1, min(request.args.get("per_page", 100, type=int), INVITE_TREE_PAGE_MAX))
+    max_depth = request.args.get("max_depth", type=int)
+    after = request.args.get("after")
+
+    conditions = ["c.ancestor = %s"]
+    params = [user_id]
+    if max_depth:
+        conditions.append("c.depth <= %s")
+        params.append(max_depth)
+    if after:
+        try:
+            after_depth, after_id = (int(v) for v in after.split(":"))
+        except ValueError:
+            return jsonify({"error": "after 参数无效"}), 400
+        conditions.append("(c.depth, c.descendant) > (%s, %s)")
+        params.extend([after_depth, after_id])
+
+    with get_conn("invite_subtree") as conn, conn.cursor() as c:
+        c.execute(f"""
+            SELECT c.descendant, c.depth, u.username, u.first_name, u.invited_by,
+                   u.phone IS NOT NULL, u.created_at
+            FROM invite_closure c
+            LEFT JOIN users u ON u.user_id = c.descendant
+            WHERE {" AND ".join(conditions)}
+            ORDER BY c.depth, c.descendant
+            LIMIT %s
+        """, params + [per_page + 1])
+        rows = c.fetchall()
+
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    return jsonify({
+        "items": [
+            {"user_id": r[0], "depth": r[1], "username": r[2], "first_name": r[3], "invited_by": r[4],
+             "authorized": r[5], "created_at": r[6].isoformat() if r[6] else None}
+            for r in rows
+        ],
+        "next": f"{rows[-1][1]}:{rows[-1][0]}" if has_next else None,
+    })
+
+
 @app.route("/update_block_status", methods=["POST"])
 def update_block_status():
     try:
         data = request.get_json()
         user_id = data.get("user_id")
         is_blocked = int(data.get("is_blocked"))
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute("UPDATE users SET is_blocked = %s WHERE user_id = %s", (is_blocked, user_id))
+        with get_conn("update_block_status") as conn, conn.cursor() as c:
+            c.execute("UPDATE users SET is_blocked = %s WHERE user_id = %s AND is_blocked IS DISTINCT FROM %s",
+                      (is_blocked, user_id, is_blocked))
+            changed = c.rowcount
             conn.commit()
+        if changed:
+            invalidate_admin_caches(int(user_id), is_blocked=is_blocked)
         return "OK"
     except Exception as e:
         logging.error(f"更新封禁状态失败: {e}")
@@ -220,74 +1738,968 @@ def update_user():
     except ValueError:
         return "参数错误", 400
 
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute(
-            "UPDATE users SET points = %s, plays = %s, is_blocked = %s WHERE user_id = %s",
-            (points, plays, is_blocked, user_id)
-        )
+    with get_conn("update_user") as conn, conn.cursor() as c:
+        # 带回修改前的封禁状态，只有真的变了才推送封禁事件
+        c.execute("""
+            UPDATE users u SET points = %s, plays = %s, is_blocked = %s
+            FROM (SELECT user_id, is_blocked FROM users WHERE user_id = %s FOR UPDATE) old
+            WHERE u.user_id = old.user_id
+            RETURNING old.is_blocked
+        """, (points, plays, is_blocked, user_id))
+        row = c.fetchone()
         conn.commit()
+    if row is None:
+        return "用户不存在", 404
+    coordinator.emit("points", [(int(user_id), points)])
+    if row[0] != is_blocked:
+        invalidate_admin_caches(int(user_id), is_blocked=is_blocked)
+    else:
+        invalidate_admin_caches(int(user_id))
     return "OK"
 
 @app.route("/delete_user", methods=["POST"])
 def delete_user():
-    user_id = request.form.get("user_id")
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
-        conn.commit()
+    user_id = int(request.form.get("user_id"))
+    with get_conn("delete_user") as conn, conn.cursor() as c:
+        _delete_users(c, [user_id])
+    coordinator.emit("removed", [user_id])
+    invalidate_admin_caches(user_id)
     return "OK"
+
+# ---------- 批量操作 ----------
+# 请求体为 JSON：{"user_ids": [...]} 或 {"filter": {"keyword": ..., "authorized": ...}}，
+# 筛选条件与首页一致。每个操作都是一条基于集合的语句，不再逐个用户请求。
+
+BULK_DELETE_BATCH_SIZE = int(os.getenv("BULK_DELETE_BATCH_SIZE", 1000))
+
+
+def _parse_user_id(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and re.fullmatch(r"-?[0-9]+", value.strip()):
+        return int(value)
+    raise ValueError(f"无效的 user_id: {value!r}")
+
+
+def _bulk_target(data):
+    """返回 (WHERE 条件, 参数)；没有 user_ids 也没有筛选条件时抛 ValueError，避免误操作全表。"""
+    user_ids = data.get("user_ids")
+    if user_ids:
+        # 字符串也能迭代，"123" 会被拆成 1、2、3 误伤别的用户，只接受列表；
+        # 列表元素可以是整数或纯数字字符串（页面从 data-user-id 属性取到的是字符串）
+        if not isinstance(user_ids, list):
+            raise ValueError("user_ids 必须是整数列表")
+        return "user_id = ANY(%s)", [[_parse_user_id(user_id) for user_id in user_ids]]
+    filters = data.get("filter") or {}
+    conditions, params = user_filters(str(filters.get("keyword", "")).strip(),
+                                      str(filters.get("authorized", "")).strip())
+    if not conditions:
+        raise ValueError("需要 user_ids 或筛选条件")
+    return f"""user_id IN (
+        SELECT u.user_id FROM users u
+        LEFT JOIN users i ON u.invited_by = i.user_id
+        WHERE {" AND ".join(conditions)}
+    )""", params
+
+
+def _delete_users(c, user_ids):
+    _lock_invite_closure(c)
+    c.execute("DELETE FROM game_history WHERE user_id = ANY(%s)", (user_ids,))
+    # 从上级的团队人数里扣掉被删的用户（max_depth 只增不减，不回算）。
+    # 被删用户的下级保留和更上层的闭包行，相当于挂到被删用户的上级下面（层级不变），
+    # 只删掉以被删用户为上级的行，闭包表和 invite_stats 保持一致
+    c.execute("""
+        WITH gone AS (
+            DELETE FROM invite_closure WHERE descendant = ANY(%(ids)s) RETURNING ancestor, depth
+        ), orphaned AS (
+            DELETE FROM invite_closure WHERE ancestor = ANY(%(ids)s) AND NOT descendant = ANY(%(ids)s)
+        ), counts AS (
+            SELECT ancestor, COUNT(*) FILTER (WHERE depth = 1) AS direct, COUNT(*) AS downline
+            FROM gone GROUP BY ancestor
+        )
+        UPDATE invite_stats s
+        SET direct = s.direct - counts.direct, downline = s.downline - counts.downline
+        FROM counts WHERE s.user_id = counts.ancestor
+    """, {"ids": user_ids})
+    c.execute("DELETE FROM invite_stats WHERE user_id = ANY(%s)", (user_ids,))
+    c.execute("DELETE FROM invite_rewards WHERE inviter = ANY(%s) OR invitee = ANY(%s)", (user_ids, user_ids))
+    c.execute("DELETE FROM users WHERE user_id = ANY(%s)", (user_ids,))
+    return c.rowcount
+
+
+def _bulk_request():
+    data = request.get_json(silent=True) or {}
+    return data, _bulk_target(data)
+
+
+@app.route("/bulk/block", methods=["POST"])
+def bulk_block():
+    try:
+        data, (target, params) = _bulk_request()
+        is_blocked = int(data.get("is_blocked", 1))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    with get_conn("bulk_block") as conn, conn.cursor() as c:
+        # 只改状态确实不同的行，推送的封禁事件里不会混进没变化的用户
+        c.execute(f"UPDATE users SET is_blocked = %s WHERE {target} AND is_blocked IS DISTINCT FROM %s "
+                  "RETURNING user_id", [is_blocked] + params + [is_blocked])
+        user_ids = [row[0] for row in c.fetchall()]
+    if user_ids:
+        invalidate_admin_caches(*user_ids, is_blocked=is_blocked)
+    logging.info(f"批量{'封禁' if is_blocked else '解封'} {len(user_ids)} 个用户")
+    return jsonify({"updated": len(user_ids)})
+
+
+@app.route("/bulk/points", methods=["POST"])
+def bulk_points():
+    try:
+        data, (target, params) = _bulk_request()
+        delta = int(data["delta"])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"参数错误: {e}"}), 400
+    with get_conn("bulk_points") as conn, conn.cursor() as c:
+        c.execute(f"UPDATE users SET points = points + %s WHERE {target} RETURNING user_id, points",
+                  [delta] + params)
+        rows = c.fetchall()
+    coordinator.emit("points", rows)
+    invalidate_admin_caches(*(row[0] for row in rows))
+    logging.info(f"批量调整积分 {delta:+d}：{len(rows)} 个用户")
+    return jsonify({"updated": len(rows)})
+
+
+@app.route("/bulk/delete", methods=["POST"])
+def bulk_delete():
+    try:
+        _, (target, params) = _bulk_request()
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    with get_conn("bulk_delete_targets") as conn, conn.cursor() as c:
+        c.execute(f"SELECT user_id FROM users WHERE {target}", params)
+        user_ids = [row[0] for row in c.fetchall()]
+    # 按批删除，每批一个事务并归还连接，游戏记录多的用户也不会长时间锁表、占住连接
+    deleted = 0
+    for i in range(0, len(user_ids), BULK_DELETE_BATCH_SIZE):
+        batch = user_ids[i:i + BULK_DELETE_BATCH_SIZE]
+        with get_conn("bulk_delete") as conn, conn.cursor() as c:
+            deleted += _delete_users(c, batch)
+        coordinator.emit("removed", batch)
+        invalidate_admin_caches(*batch)
+    logging.info(f"批量删除 {deleted} 个用户")
+    return jsonify({"deleted": deleted})
     
+@app.route("/pool_stats")
+def pool_stats():
+    return jsonify(db.stats())
+
+@app.route("/join_stats")
+def join_stats():
+    return jsonify(join_buffer.stats())
+
+@app.route("/outbox_stats")
+def outbox_stats():
+    return jsonify(outbox.stats())
+
+@app.route("/user_cache_stats")
+def user_cache_stats():
+    return jsonify(user_states.stats())
+
+@app.route("/bot_api_stats")
+def bot_api_stats():
+    data = {}
+    for (handler, api_method), count in bot_api_calls.items():
+        data.setdefault(handler, {})[api_method] = count
+    return jsonify(data)
+
+@app.route("/coordination_stats")
+def coordination_stats():
+    return jsonify(coordinator.stats())
+
+@app.route("/live_stats")
+def live_stats():
+    return jsonify(live_events.stats())
+
+@app.route("/job_stats")
+def job_stats_view():
+    return jsonify(job_stats)
+
+@app.route("/dashboard_totals")
+def dashboard_totals_view():
+    # 不走 stats_cache / 响应缓存：首页的统计可能来自缓存，实时推送的增量要叠加在准确的基数上
+    with get_conn("dashboard_totals") as conn, conn.cursor() as c:
+        total_users, authorized_users, blocked_users, total_points = _query_dashboard_totals(c)
+    resp = jsonify({"total_users": total_users, "authorized_users": authorized_users,
+                    "blocked_users": blocked_users, "total_points": total_points})
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
 @app.route('/rank_data')
+@cached_response
 def rank_data():
-    today = date.today().isoformat()
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT username, first_name, points FROM users WHERE last_play LIKE %s ORDER BY points DESC LIMIT 10", (f"{today}%",))
-        rows = c.fetchall()
-    data = [
-        {"username": r[0], "first_name": r[1], "points": r[2]}
-        for r in rows
-    ]
+    data = leaderboard.cache.get("json")
+    if data is None:
+        if not leaderboard_live:
+            # 独立后台进程没有开启多实例协调时收不到结算更新，缓存过期后从数据库重新加载
+            leaderboard.load(db.run(_load_leaderboard), replace=True)
+        data = leaderboard.cache.set("json", [
+            {"username": r[0], "first_name": r[1], "points": r[2]}
+            for r in leaderboard.top()
+        ])
     return jsonify(data)
 
 @app.route("/game_history")
+@cached_response
 def game_history():
     try:
         user_id = request.args.get("user_id")
-        page = int(request.args.get("page", 1))
+        after = request.args.get("after")
+        before = request.args.get("before")
         per_page = 50
 
-        where_sql = ""
+        conditions = []
         params = []
 
         if user_id:
-            where_sql = "WHERE user_id = %s"
+            conditions.append("user_id = %s")
             params.append(user_id)
 
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute(f"SELECT COUNT(*) FROM game_history {where_sql}", params)
-            total_count = c.fetchone()[0]
-
-            offset = (page - 1) * per_page
+        with get_conn("game_history") as conn, conn.cursor() as c:
+            total_count, count_is_estimate = estimate_count(
+                c, "game_history",
+                "SELECT COUNT(*) FROM game_history WHERE user_id = %s" if user_id else None, params)
 
-            c.execute(f"""
-                SELECT user_id, created_at, user_score, bot_score, result, points_change
+            records, has_prev, has_next = keyset_paginate(c, """
+                SELECT user_id, created_at, user_score, bot_score, result, points_change, id
                 FROM game_history
-                {where_sql}
-                ORDER BY created_at DESC
-                LIMIT %s OFFSET %s
-            """, params + [per_page, offset])
-
-            records = c.fetchall()
-
-        total_pages = (total_count + per_page - 1) // per_page
+                {where}
+                ORDER BY {order}
+            """, conditions, params, ("created_at", "id"), after, before, per_page)
 
         return render_template("game_history.html",
                                records=records,
-                               page=page,
-                               total_pages=total_pages,
+                               total_count=total_count,
+                               count_is_estimate=count_is_estimate,
+                               prev_cursor=encode_cursor(records[0][1], records[0][6]) if has_prev and records else None,
+                               next_cursor=encode_cursor(records[-1][1], records[-1][6]) if has_next and records else None,
                                user_id=user_id)
     except Exception as e:
         import traceback
-        return f"<pre>出错了：\n{traceback.format_exc()}</pre>"
+        return f"<pre>出错了：\n{traceback.format_exc()}</pre>", 500
+
+# ---------- 趋势汇总 ----------
+# 定时任务按 game_history.id 水位增量汇总到 game_rollups，后台趋势图只读汇总表，不扫原始记录。
+
+ROLLUP_INTERVAL_SECONDS = int(os.getenv("ROLLUP_INTERVAL_SECONDS", 60))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", 20000))
+# 只汇总这么久以前写入的记录：id 小的事务（含写入缓冲）可能比 id 大的晚提交，留出余量水位才不会越过它们
+ROLLUP_LAG_SECONDS = int(os.getenv("ROLLUP_LAG_SECONDS", 30))
+# 玩家明细保留当前桶之前的几个桶，更早的桶视为已结束，清掉明细只留计数
+ROLLUP_PLAYER_RETENTION = 2
+ROLLUP_RANGE_MAX_DAYS = 400
+ROLLUP_GRAINS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+ROLLUP_SQL = """
+    WITH buckets AS (
+        SELECT g.grain, date_trunc(g.grain, h.created_at) AS bucket, h.user_id, h.result, h.points_change
+        FROM game_history h CROSS JOIN (VALUES ('hour'), ('day')) AS g (grain)
+        WHERE h.id > %(lo)s AND h.id <= %(hi)s
+    ), new_players AS (
+        -- 只有第一次出现在这个桶里的玩家会插入成功，插入的行数就是去重人数的增量
+        INSERT INTO game_rollup_players (grain, bucket, user_id)
+        SELECT DISTINCT grain, bucket, user_id FROM buckets
+        ORDER BY 1, 2, 3
+        ON CONFLICT DO NOTHING
+        RETURNING grain, bucket
+    ), player_counts AS (
+        SELECT grain, bucket, COUNT(*) AS players FROM new_players GROUP BY grain, bucket
+    )
+    INSERT INTO game_rollups AS r (grain, bucket, games, wins, losses, ties, points, players)
+    SELECT b.grain, b.bucket, COUNT(*),
+           COUNT(*) FILTER (WHERE b.result = '赢'),
+           COUNT(*) FILTER (WHERE b.result = '输'),
+           COUNT(*) FILTER (WHERE b.result = '平局'),
+           COALESCE(SUM(b.points_change), 0),
+           COALESCE(MAX(p.players), 0)
+    FROM buckets b
+    LEFT JOIN player_counts p USING (grain, bucket)
+    GROUP BY b.grain, b.bucket
+    ORDER BY b.grain, b.bucket
+    ON CONFLICT (grain, bucket) DO UPDATE SET
+        games = r.games + EXCLUDED.games,
+        wins = r.wins + EXCLUDED.wins,
+        losses = r.losses + EXCLUDED.losses,
+        ties = r.ties + EXCLUDED.ties,
+        points = r.points + EXCLUDED.points,
+        players = r.players + EXCLUDED.players
+"""
+
+
+def _rollup_batch(c, cutoff, batch_size):
+    """汇总水位之后的一批记录并推进水位，同一事务内完成；返回 (汇总行数, 是否还有下一批)。"""
+    # 锁住水位行，即使两个实例同时跑也只会串行推进
+    c.execute("SELECT last_id FROM rollup_state WHERE name = 'game_history' FOR UPDATE")
+    last_id = c.fetchone()[0]
+    c.execute("""
+        SELECT id, created_at < %s FROM game_history
+        WHERE id > %s ORDER BY id LIMIT %s
+    """, (cutoff, last_id, batch_size))
+    rows = c.fetchall()
+    # 遇到第一条还在等待期内的记录就停下，之后的留到下一轮
+    ready = len(list(itertools.takewhile(lambda r: r[1], rows)))
+    if not ready:
+        return 0, False
+    hi = rows[ready - 1][0]
+    c.execute(ROLLUP_SQL, {"lo": last_id, "hi": hi})
+    c.execute("UPDATE rollup_state SET last_id = %s WHERE name = 'game_history'", (hi,))
+    return ready, ready == batch_size
+
+
+def _prune_rollup_players(c, now):
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    c.execute("""
+        DELETE FROM game_rollup_players
+        WHERE (grain = 'hour' AND bucket < %s) OR (grain = 'day' AND bucket < %s)
+    """, (hour - ROLLUP_GRAINS["hour"] * ROLLUP_PLAYER_RETENTION,
+          hour.replace(hour=0) - ROLLUP_GRAINS["day"] * ROLLUP_PLAYER_RETENTION))
+    return c.rowcount
+
+
+@leader_only
+async def rollup_game_history():
+    start = time.monotonic()
+    total = batches = 0
+    more = True
+    while more:
+        count, more = await db.arun(_rollup_batch, datetime.now() - timedelta(seconds=ROLLUP_LAG_SECONDS),
+                                    ROLLUP_BATCH_SIZE)
+        total += count
+        batches += 1 if count else 0
+    pruned = await db.arun(_prune_rollup_players, datetime.now())
+    duration = time.monotonic() - start
+    job_seconds.observe(duration, "rollup_game_history")
+    job_stats["rollup_game_history"] = {
+        "finished_at": datetime.now().isoformat(),
+        "rows": total,
+        "batches": batches,
+        "pruned_players": pruned,
+        "duration_seconds": round(duration, 3),
+    }
+    logging.debug(f"📈 游戏记录汇总：{total} 行，{batches} 批，用时 {duration:.2f}s")
+
+
+@app.route("/game_rollups")
+@cached_response
+def game_rollups():
+    """按小时或按天的趋势数据；没有对局的桶补 0，方便直接画图。"""
+    grain = request.args.get("grain", "hour")
+    if grain not in ROLLUP_GRAINS:
+        return jsonify({"error": "grain 只支持 hour 或 day"}), 400
+    days = request.args.get("days", 2 if grain == "hour" else 30, type=int)
+    days = min(max(days, 1), ROLLUP_RANGE_MAX_DAYS)
+    step = ROLLUP_GRAINS[grain]
+    now = datetime.now()
+    end = now.replace(minute=0, second=0, microsecond=0)
+    if grain == "day":
+        end = end.replace(hour=0)
+    start = end - timedelta(days=days) + step
+
+    with get_conn("game_rollups") as conn, conn.cursor() as c:
+        c.execute("""
+            SELECT bucket, games, wins, losses, ties, points, players FROM game_rollups
+            WHERE grain = %s AND bucket >= %s ORDER BY bucket
+        """, (grain, start))
+        rows = {r[0]: r[1:] for r in c.fetchall()}
+        c.execute("SELECT last_id FROM rollup_state WHERE name = 'game_history'")
+        last_id = c.fetchone()[0]
+
+    items = []
+    bucket = start
+    while bucket <= end:
+        games, wins, losses, ties, points, players = rows.get(bucket, (0, 0, 0, 0, 0, 0))
+        items.append({"bucket": bucket.isoformat(), "games": games, "wins": wins, "losses": losses,
+                      "ties": ties, "points": points, "players": players})
+        bucket += step
+    return jsonify({"grain": grain, "last_id": last_id, "items": items})
+
+# ---------- 游戏记录分区 ----------
+# game_history 按 created_at 每月一个分区（game_history_y2026m01），提前建好未来几个月的分区。
+# 保留期之外的分区先导出成 gzip 压缩的 CSV，再从主表摘下并删除；汇总表 game_rollups 不受影响。
+# 摘分区用 DETACH PARTITION ... CONCURRENTLY，只等旧查询结束，不会排在长查询后面挡住写入。
+
+# 预建当前月之后几个月的分区；没有默认分区，写入没有分区的月份会报错
+GAME_HISTORY_PARTITIONS_AHEAD = int(os.getenv("GAME_HISTORY_PARTITIONS_AHEAD", 3))
+# 保留最近几个月（含当前月）的记录，0 表示不清理
+GAME_HISTORY_RETENTION_MONTHS = int(os.getenv("GAME_HISTORY_RETENTION_MONTHS", 0))
+# 归档文件写在 leader 实例本地的这个目录
+GAME_HISTORY_ARCHIVE_DIR = os.getenv("GAME_HISTORY_ARCHIVE_DIR", "archive")
+# 不支持 CONCURRENTLY（PostgreSQL 14 以前）时普通 DETACH 以及删表最多等锁这么久，拿不到就下次再试
+GAME_HISTORY_DETACH_LOCK_TIMEOUT = os.getenv("GAME_HISTORY_DETACH_LOCK_TIMEOUT", "5s")
+# 预建分区（CREATE TABLE ... PARTITION OF）同样要锁主表，最多等这么久，拿不到就下次再建
+GAME_HISTORY_PARTITION_LOCK_TIMEOUT = os.getenv("GAME_HISTORY_PARTITION_LOCK_TIMEOUT",
+                                                GAME_HISTORY_DETACH_LOCK_TIMEOUT)
+
+
+def _add_months(month, n):
+    years, index = divmod(month.month - 1 + n, 12)
+    return datetime(month.year + years, index + 1, 1)
+
+
+def _history_partition_name(month):
+    return f"game_history_y{month.year}m{month.month:02d}"
+
+
+def _create_history_partition(c, month, parent="game_history"):
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_history_partition_name(month)}
+        PARTITION OF {parent} FOR VALUES FROM (%s) TO (%s)
+    """, (month, _add_months(month, 1)))
+
+
+def _ensure_history_partitions(c, now, parent="game_history"):
+    """预建当前月及之后的分区；等主表的锁超时就放弃，返回 False，已经提前几个月预建，下次任务再补。"""
+    first = datetime(now.year, now.month, 1)
+    months = [_add_months(first, i) for i in range(GAME_HISTORY_PARTITIONS_AHEAD + 1)]
+    # 已有的分区不再执行 CREATE，免得白白排队等主表的锁
+    c.execute("SELECT name FROM unnest(%s::text[]) name WHERE to_regclass(name) IS NULL",
+              ([_history_partition_name(month) for month in months],))
+    missing = {row[0] for row in c.fetchall()}
+    if not missing:
+        return True
+    c.execute("SET lock_timeout = %s", (GAME_HISTORY_PARTITION_LOCK_TIMEOUT,))
+    try:
+        for month in months:
+            if _history_partition_name(month) in missing:
+                _create_history_partition(c, month, parent)
+    except psycopg2.errors.LockNotAvailable:
+        logging.warning(f"⚠️ 预建 {parent} 分区等锁超时，下次再建")
+        # 事务里出错时整个事务回滚，SET 随之撤销；autocommit 连接要手动恢复
+        if c.connection.autocommit:
+            c.execute("RESET lock_timeout")
+        return False
+    c.execute("RESET lock_timeout")
+    return True
+
+
+def _history_partitions(c):
+    """
+    返回按月份排序的 [(月份, 分区名, 状态)]。状态为 attached；pending 表示上次
+    DETACH ... CONCURRENTLY 中途中断；detached 表示已经摘下但还没删掉的表。
+    """
+    # inhdetachpending 从 PostgreSQL 14 开始才有
+    pending = "i.inhdetachpending" if c.connection.server_version >= 140000 else "false"
+    c.execute(f"""
+        SELECT cl.relname,
+               CASE WHEN i.inhrelid IS NULL THEN 'detached'
+                    WHEN {pending} THEN 'pending'
+                    ELSE 'attached' END
+        FROM pg_class cl
+        LEFT JOIN pg_inherits i ON i.inhrelid = cl.oid
+        WHERE cl.relkind = 'r' AND cl.relnamespace = 'public'::regnamespace
+          AND cl.relname ~ '^game_history_y[0-9]{{4}}m[0-9]{{2}}$'
+          AND (i.inhparent IS NULL OR i.inhparent = 'game_history'::regclass)
+    """)
+    return sorted(
+        (datetime.strptime(name[len("game_history_"):], "y%Ym%m"), name, state)
+        for name, state in c.fetchall()
+    )
+
+
+def _archive_history_partition(c, name, path):
+    # 先写临时文件，导出完整后才改名，中途失败不会留下半个归档
+    tmp = f"{path}.tmp"
+    with gzip.open(tmp, "wb") as f:
+        c.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+    os.replace(tmp, path)
+
+
+def _drop_history_partition(name, state):
+    # DETACH ... CONCURRENTLY 不能在事务块里执行，用独立的 autocommit 连接
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as c:
+            if state == "pending":
+                c.execute(f"ALTER TABLE game_history DETACH PARTITION {name} FINALIZE")
+            elif state == "attached" and conn.server_version >= 140000:
+                c.execute(f"ALTER TABLE game_history DETACH PARTITION {name} CONCURRENTLY")
+            # 普通 DETACH 要对主表加 ACCESS EXCLUSIVE 锁，排队期间会挡住写入，等不到锁就放弃
+            c.execute("SET lock_timeout = %s", (GAME_HISTORY_DETACH_LOCK_TIMEOUT,))
+            if state == "attached" and conn.server_version < 140000:
+                c.execute(f"ALTER TABLE game_history DETACH PARTITION {name}")
+            c.execute(f"DROP TABLE {name}")
+    finally:
+        conn.close()
+
+
+@leader_only
+async def maintain_history_partitions():
+    start = time.monotonic()
+    now = datetime.now()
+    partitions_ready = await db.arun(_ensure_history_partitions, now)
+    archived = []
+    if GAME_HISTORY_RETENTION_MONTHS > 0:
+        keep_from = _add_months(datetime(now.year, now.month, 1), 1 - GAME_HISTORY_RETENTION_MONTHS)
+        os.makedirs(GAME_HISTORY_ARCHIVE_DIR, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        for month, name, state in await db.arun(_history_partitions):
+            if month >= keep_from:
+                break
+            path = os.path.join(GAME_HISTORY_ARCHIVE_DIR, f"{name}.csv.gz")
+            await db.arun(_archive_history_partition, name, path)
+            try:
+                await loop.run_in_executor(None, _drop_history_partition, name, state)
+            except psycopg2.errors.LockNotAvailable:
+                # 按月份顺序处理，停在这里，下次任务从这个分区继续
+                logging.warning(f"⚠️ 游戏记录分区 {name} 等锁超时，下次再摘除")
+                break
+            archived.append(name)
+            logging.info(f"🗄 已归档游戏记录分区 {name} → {path}")
+    duration = time.monotonic() - start
+    job_seconds.observe(duration, "maintain_history_partitions")
+    job_stats["maintain_history_partitions"] = {
+        "finished_at": datetime.now().isoformat(),
+        "partitions_ready": partitions_ready,
+        "archived": archived,
+        "duration_seconds": round(duration, 3),
+    }
+
+# ---------- 数据导出 ----------
+
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 2000))
+
+# 可选的单次导出上限：Hypercorn 的 WSGI 适配层察觉不到客户端断开，中途放弃的下载也会一直读到结束，
+# 需要限制它占用 web 线程和连接的时间时再设置。EXPORT_MAX_ROWS 为 0 表示不限行数，超过上限时
+# 文件末尾写一行截断标记；EXPORT_STATEMENT_TIMEOUT 限制每次取数，为 0 表示不限。
+# 注意带筛选、排序的大导出第一次取数要先完成排序，超时设得太短会在导出中途失败。
+EXPORT_MAX_ROWS = int(os.getenv("EXPORT_MAX_ROWS", 0))
+EXPORT_STATEMENT_TIMEOUT = os.getenv("EXPORT_STATEMENT_TIMEOUT", "0")
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+
+USER_EXPORT_COLUMNS = ("user_id", "first_name", "last_name", "username", "phone", "points", "plays",
+                       "created_at", "last_play", "invited_by", "is_blocked", "inviter_username")
+INVITEE_EXPORT_COLUMNS = ("user_id", "username", "phone", "points", "plays", "created_at", "last_play")
+HISTORY_EXPORT_COLUMNS = ("id", "user_id", "created_at", "user_score", "bot_score", "result", "points_change")
+
+
+def _export_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _encode_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows([_export_value(v) for v in row] for row in rows)
+    return buf.getvalue()
+
+
+def _encode_ndjson(columns, rows):
+    return "".join(
+        json.dumps({k: _export_value(v) for k, v in zip(columns, row)}, ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def stream_export(name, sql, params, columns):
+    """
+    用服务端命名游标分批读取并逐块输出，导出多少行内存都保持不变。
+    连接在整个下载期间占用；客户端中途断开时导出不会提前结束，上限见 EXPORT_MAX_ROWS。
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return "format 只支持 csv 或 ndjson", 400
+
+    def generate():
+        with get_conn(f"export_{name}") as conn, conn.cursor(name="export") as c:
+            c.itersize = EXPORT_FETCH_SIZE
+            with conn.cursor() as setup:
+                setup.execute("SET LOCAL statement_timeout = %s", (EXPORT_STATEMENT_TIMEOUT,))
+            if EXPORT_MAX_ROWS > 0:
+                # 多取一行，用来判断是否被截断
+                c.execute(f"{sql} LIMIT %s", [*params, EXPORT_MAX_ROWS + 1])
+            else:
+                c.execute(sql, params)
+            if fmt == "csv":
+                # 带 BOM，Excel 打开中文不乱码
+                yield "\ufeff" + _encode_csv([columns])
+            exported, truncated = 0, False
+            while True:
+                rows = c.fetchmany(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                if EXPORT_MAX_ROWS > 0 and exported + len(rows) > EXPORT_MAX_ROWS:
+                    rows, truncated = rows[:EXPORT_MAX_ROWS - exported], True
+                exported += len(rows)
+                if rows:
+                    yield _encode_csv(rows) if fmt == "csv" else _encode_ndjson(columns, rows)
+                if truncated:
+                    break
+            if truncated:
+                logging.warning(f"导出 {name} 达到上限 {EXPORT_MAX_ROWS} 行，已截断")
+                yield (f"# truncated: 超过导出上限 {EXPORT_MAX_ROWS} 行，后续数据未导出\n" if fmt == "csv"
+                       else json.dumps({"truncated": True, "limit": EXPORT_MAX_ROWS}) + "\n")
+
+    filename = f"{name}_{datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    resp = Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt])
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    resp.headers["Cache-Control"] = "no-store"
+    if EXPORT_MAX_ROWS > 0:
+        resp.headers["X-Export-Limit"] = str(EXPORT_MAX_ROWS)
+    return resp
+
+
+@app.route("/export/users")
+def export_users():
+    keyword = request.args.get("keyword", "").strip()
+    authorized = request.args.get("authorized", "").strip()
+    conditions, params = user_filters(keyword, authorized)
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return stream_export("users", f"""
+        SELECT u.user_id, u.first_name, u.last_name, u.username, u.phone, u.points, u.plays,
+               u.created_at, u.last_play, u.invited_by, u.is_blocked,
+               i.username AS inviter_username
+        FROM users u
+        LEFT JOIN users i ON u.invited_by = i.user_id
+        {where_sql}
+        ORDER BY u.created_at DESC, u.user_id DESC
+    """, params, USER_EXPORT_COLUMNS)
+
+
+@app.route("/export/invitees")
+def export_invitees():
+    inviter_id = request.args.get("user_id", type=int)
+    if inviter_id is None:
+        return "缺少或无效的邀请人 user_id 参数", 400
+    return stream_export("invitees", """
+        SELECT user_id, username, phone, points, plays, created_at, last_play
+        FROM users WHERE invited_by = %s
+        ORDER BY created_at DESC, user_id DESC
+    """, (inviter_id,), INVITEE_EXPORT_COLUMNS)
+
+
+@app.route("/export/game_history")
+def export_game_history():
+    user_id = request.args.get("user_id") or None
+    if user_id is not None:
+        # 响应头发出之后再出错只能得到一个截断的 200，参数要在开始输出前校验
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return "user_id 参数无效", 400
+    where_sql = "WHERE user_id = %s" if user_id is not None else ""
+    return stream_export("game_history", f"""
+        SELECT id, user_id, created_at, user_score, bot_score, result, points_change
+        FROM game_history
+        {where_sql}
+        ORDER BY created_at DESC, id DESC
+    """, (user_id,) if user_id is not None else (), HISTORY_EXPORT_COLUMNS)
+
+# ---------- Bot API 调用统计 ----------
+
+BOT_CONNECTION_POOL_SIZE = int(os.getenv("BOT_CONNECTION_POOL_SIZE", 256))
+BOT_PROFILE_REFRESH_HOURS = float(os.getenv("BOT_PROFILE_REFRESH_HOURS", 6))
+
+# 当前正在执行的 handler / 定时步骤名，用于把 Bot API 调用归到对应的 handler
+current_handler = contextvars.ContextVar("current_handler", default="other")
+bot_api_calls = Counter()
+
+
+def track_handler(func):
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_handler.set(name)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+            current_handler.reset(token)
+    return wrapper
+
+
+class CountingRequest(HTTPXRequest):
+    """按 (handler, API 方法) 统计发往 Telegram 的请求次数，并按方法记录耗时。"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        bot_api_calls[(current_handler.get(), api_method)] += 1
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data=request_data, **kwargs)
+        except Exception:
+            bot_api_errors.inc(api_method)
+            raise
+        finally:
+            bot_api_seconds.observe(time.perf_counter() - start, api_method)
+
+
+def invite_link(bot, user_id):
+    # bot.username 来自启动时缓存的 getMe 结果，不产生 API 调用
+    return f"https://t.me/{bot.username}?start={user_id}"
+
+
+async def refresh_bot_profile():
+    if bot_application is not None:
+        me = await bot_application.bot.get_me()
+        logging.info(f"🤖 已刷新机器人资料：@{me.username}")
+
+# ---------- 发送队列 ----------
+# 所有游戏相关的发送都经过 outbox：全局 + 每个聊天的令牌桶限速，按优先级发送，
+# 遇到 RetryAfter 自动退避重试，同一用户重复的提示消息会被合并。
+
+PRIORITY_GAME = 0
+PRIORITY_PROMPT = 1
+PRIORITY_NOTIFY = 2
+
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 30))
+OUTBOX_GROUP_RATE_PER_MIN = float(os.getenv("OUTBOX_GROUP_RATE_PER_MIN", 20))
+OUTBOX_GROUP_BURST = int(os.getenv("OUTBOX_GROUP_BURST", 10))
+OUTBOX_PRIVATE_RATE = float(os.getenv("OUTBOX_PRIVATE_RATE", 1))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 32))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 3))
+# 积压超过 OUTBOX_SHED_DEPTH 时丢弃新的提示消息；超过 OUTBOX_MAX_DEPTH 时拒绝一切新消息
+OUTBOX_SHED_DEPTH = int(os.getenv("OUTBOX_SHED_DEPTH", 1000))
+OUTBOX_MAX_DEPTH = int(os.getenv("OUTBOX_MAX_DEPTH", 10000))
+# 每隔这么久清理一次已经补满的会话令牌桶，避免 _chats 随会话数无限增长
+OUTBOX_BUCKET_SWEEP_SECONDS = float(os.getenv("OUTBOX_BUCKET_SWEEP_SECONDS", 60))
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class OutboxExpired(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self):
+        """消耗一个令牌，返回需要等待的秒数（0 表示可以立即发送）。
+
+        没有令牌时也会预订一个（令牌数记为负），调用方等待返回的秒数后直接发送即可；
+        同一个桶上排队的消息因此依次错开唤醒，不会同时醒来争抢同一个令牌。
+        """
+        now = time.monotonic()
+        start = max(now, self.paused_until)
+        self._refill(start)
+        wait = start - now
+        if self.tokens < 1:
+            wait += (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return wait
+
+    def refund(self):
+        # 预订了令牌但最终没有发送（排队超时）时归还
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds):
+        now = time.monotonic()
+        self._refill(now)
+        self.paused_until = max(self.paused_until, now + seconds)
+        # 暂停期间不补充令牌
+        self.updated = max(self.updated, self.paused_until)
+
+    def is_idle(self, now):
+        """令牌已补满且没有暂停，丢弃后重建的桶与之等价。"""
+        if now < self.paused_until:
+            return False
+        return self.tokens + max(0.0, now - self.updated) * self.rate >= self.capacity
+
+
+@dataclass(order=True)
+class OutboundMessage:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    send: object = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    coalesce_key: object = field(compare=False, default=None)
+    submitted_at: float = field(compare=False, default=0.0)
+    attempts: int = field(compare=False, default=0)
+    handler: str = field(compare=False, default="other")
+    deadline: float = field(compare=False, default=None)
+    reserved: bool = field(compare=False, default=False)
+
+
+class Outbox:
+    def __init__(self):
+        self._queue = None
+        self._seq = itertools.count()
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._chats = {}
+        self._swept_at = time.monotonic()
+        self._coalescing = {}
+        self._parked = 0
+        self._latencies = deque(maxlen=1000)
+        self._stats = Counter()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(OUTBOX_GROUP_RATE_PER_MIN / 60, OUTBOX_GROUP_BURST)
+            else:
+                bucket = TokenBucket(OUTBOX_PRIVATE_RATE, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _sweep_buckets(self):
+        now = time.monotonic()
+        if now - self._swept_at < OUTBOX_BUCKET_SWEEP_SECONDS:
+            return
+        self._swept_at = now
+        idle = [chat_id for chat_id, bucket in self._chats.items() if bucket.is_idle(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        self._stats["buckets_evicted"] += len(idle)
+
+    @property
+    def depth(self):
+        return (self._queue.qsize() if self._queue else 0) + self._parked
+
+    def submit(self, priority, chat_id, send, coalesce_key=None, max_wait=None):
+        """send 为无参函数，返回发送消息的协程；返回结果 future。
+
+        max_wait 秒内没能发出的消息不再发送，future 以 OutboxExpired 结束。
+        """
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if coalesce_key is not None and coalesce_key in self._coalescing:
+            self._stats["coalesced"] += 1
+            return self._coalescing[coalesce_key]
+        future = asyncio.get_running_loop().create_future()
+        depth = self.depth
+        if depth >= OUTBOX_MAX_DEPTH or (priority == PRIORITY_PROMPT and depth >= OUTBOX_SHED_DEPTH):
+            # 提示消息丢了无所谓，直接当作已处理；其他消息让调用方知道没有发出
+            if priority == PRIORITY_PROMPT:
+                self._stats["shed"] += 1
+                future.set_result(None)
+            else:
+                self._stats["rejected"] += 1
+                future.set_exception(OutboxFull(f"发送队列积压 {depth} 条"))
+            return future
+        now = time.monotonic()
+        message = OutboundMessage(priority, next(self._seq), chat_id, send, future,
+                                  coalesce_key, now, handler=current_handler.get(),
+                                  deadline=now + max_wait if max_wait is not None else None)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = future
+        self._queue.put_nowait(message)
+        return future
+
+    async def send(self, priority, chat_id, send, coalesce_key=None):
+        return await self.submit(priority, chat_id, send, coalesce_key)
+
+    def post(self, priority, chat_id, send, coalesce_key=None):
+        # 不关心结果的发送，失败只记录日志
+        future = self.submit(priority, chat_id, send, coalesce_key)
+        future.add_done_callback(_log_outbox_failure)
+
+    def _requeue_later(self, message, delay):
+        self._parked += 1
+
+        def requeue():
+            self._parked -= 1
+            self._queue.put_nowait(message)
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def run(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        while True:
+            message = await self._queue.get()
+            self._sweep_buckets()
+            if message.deadline is not None and time.monotonic() > message.deadline:
+                self._stats["expired"] += 1
+                if message.reserved:
+                    self._chat_bucket(message.chat_id).refund()
+                self._finish(message, exception=OutboxExpired("消息排队超时，未发送"))
+                continue
+            if not message.reserved:
+                delay = self._chat_bucket(message.chat_id).take()
+                if delay > 0:
+                    # 令牌已经预订，到点后直接发送
+                    message.reserved = True
+                    self._requeue_later(message, delay)
+                    continue
+            message.reserved = False
+            while (delay := self._global.take()) > 0:
+                await asyncio.sleep(delay)
+            await slots.acquire()
+            asyncio.create_task(self._deliver(message, slots))
+
+    async def _deliver(self, message, slots):
+        current_handler.set(message.handler)
+        try:
+            result = await message.send()
+        except RetryAfter as e:
+            self._stats["retry_after"] += 1
+            retry_after = e.retry_after
+            self._chat_bucket(message.chat_id).pause(retry_after)
+            message.attempts += 1
+            if message.attempts <= OUTBOX_MAX_RETRIES:
+                self._requeue_later(message, retry_after)
+                return
+            self._finish(message, exception=e)
+        except Exception as e:
+            self._finish(message, exception=e)
+        else:
+            self._finish(message, result=result)
+        finally:
+            slots.release()
+
+    def _finish(self, message, result=None, exception=None):
+        if message.coalesce_key is not None:
+            self._coalescing.pop(message.coalesce_key, None)
+        if exception is not None:
+            self._stats["failed"] += 1
+            if not message.future.done():
+                message.future.set_exception(exception)
+            return
+        self._stats["sent"] += 1
+        self._latencies.append(time.monotonic() - message.submitted_at)
+        if not message.future.done():
+            message.future.set_result(result)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        stats = dict(self._stats)
+        stats["queue_depth"] = self.depth
+        stats["parked"] = self._parked
+        if latencies:
+            stats["latency_p50"] = round(latencies[len(latencies) // 2], 4)
+            stats["latency_p99"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 4)
+        return stats
+
+
+def _log_outbox_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.warning(f"消息发送失败: {future.exception()}")
+
+
+outbox = Outbox()
 
 async def send_game_rules(chat_id, bot, language_code='zh'):
     if language_code and language_code.startswith('en'):
@@ -314,12 +2726,14 @@ async def send_game_rules(chat_id, bot, language_code='zh'):
         )
     await bot.send_message(chat_id=chat_id, text=text)
 
+@track_handler
 async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_lang = query.from_user.language_code or 'zh'
     await send_game_rules(query.message.chat_id, context.bot, user_lang)
 
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     inviter_id = int(context.args[0]) if context.args else None
@@ -328,15 +2742,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if inviter_id == user.id:
         inviter_id = None
 
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT 1 FROM users WHERE user_id = %s", (user.id,))
-        if not c.fetchone():
-            now = datetime.now().isoformat()
-            c.execute("""
-                INSERT INTO users (user_id, first_name, last_name, username, plays, points, created_at, invited_by)
-                VALUES (%s, %s, %s, %s, 0, 0, %s, %s)
-            """, (user.id, user.first_name, user.last_name, user.username, now, inviter_id))
-            conn.commit()
+    inserted = await db.arun(_insert_users, [(user.id, user.first_name, user.last_name, user.username, inviter_id)])
+    if inserted:
+        coordinator.emit("joined", inserted)
 
     keyboard = ReplyKeyboardMarkup(
         [[KeyboardButton("📱 分享手机号", request_contact=True)]],
@@ -345,6 +2753,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⚠️ 为参与群组游戏，请先授权手机号：", reply_markup=keyboard)
     await update.message.reply_text("ℹ️ 想了解游戏玩法，请发送 /help 查看详细说明。")
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_lang = update.effective_user.language_code or 'zh'
     if user_lang.startswith('en'):
@@ -377,194 +2786,569 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     await update.message.reply_text(help_text)
 
+@track_handler
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not update.message.contact or update.message.contact.user_id != user.id:
         await update.message.reply_text("⚠️ 请发送您自己的手机号授权。")
         return
     phone = update.message.contact.phone_number
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("UPDATE users SET phone = %s WHERE user_id = %s", (phone, user.id))
-        conn.commit()
+    await db.execute("UPDATE users SET phone = %s WHERE user_id = %s", (phone, user.id), name="save_phone")
+    coordinator.emit("users", [user.id])
 
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎲 开始游戏", callback_data="start_game")]])
     await update.message.reply_text("✅ 手机号授权成功！点击按钮开始游戏吧～", reply_markup=keyboard)
-    await reward_inviter(user.id, context)
+    reward_worker.submit(user.id)
+
+INVITE_REWARD_POINTS = 10
+INVITE_REWARD_BATCH_SIZE = int(os.getenv("INVITE_REWARD_BATCH_SIZE", 200))
+INVITE_REWARD_LOCK_ID = 727003
+
+# 邀请奖励：被邀请人授权手机号并参与过游戏后，邀请人获得积分。
+# 先给邀请人加分，再只为加分成功的记录写 reward_given：邀请人还没注册时
+# 这一对保持未发放，等邀请人注册后还能补发；旧版本留下的 reward_given = FALSE
+# 记录也会在这里补发。
+GRANT_INVITE_REWARDS_SQL = """
+    WITH eligible AS (
+        SELECT u.user_id AS invitee, u.invited_by AS inviter
+        FROM users u
+        JOIN users i ON i.user_id = u.invited_by
+        WHERE u.invited_by IS NOT NULL AND u.invited_by <> u.user_id
+          AND u.phone IS NOT NULL AND u.last_play IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM invite_rewards r
+              WHERE r.inviter = u.invited_by AND r.invitee = u.user_id AND r.reward_given
+          )
+          {filter}
+    ), totals AS (
+        SELECT inviter, COUNT(*) AS rewards FROM eligible GROUP BY inviter
+    ), paid AS (
+        UPDATE users u SET points = u.points + %(points)s * totals.rewards
+        FROM totals WHERE u.user_id = totals.inviter
+        RETURNING u.user_id, u.points, totals.rewards
+    ), flagged AS (
+        INSERT INTO invite_rewards (inviter, invitee, reward_given)
+        SELECT e.inviter, e.invitee, TRUE FROM eligible e JOIN paid p ON p.user_id = e.inviter
+        ON CONFLICT (inviter, invitee) DO UPDATE SET reward_given = TRUE
+    )
+    SELECT user_id, points, rewards FROM paid
+"""
 
-async def reward_inviter(user_id, context):
-    try:
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute("SELECT invited_by, plays FROM users WHERE user_id = %s", (user_id,))
-            row = c.fetchone()
-            if not row:
+
+def _lock_invite_rewards(c):
+    # 加分在写标记之前，并发的两次发放会各自加一次分；
+    # 用事务级 advisory 锁串行化（跨实例、跨对账任务），提交时自动释放
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (INVITE_REWARD_LOCK_ID,))
+
+
+def _grant_invite_rewards(c, user_ids):
+    # 既处理这些用户作为被邀请人的奖励，也补发他们作为邀请人此前因未注册而挂起的奖励
+    _lock_invite_rewards(c)
+    c.execute(GRANT_INVITE_REWARDS_SQL.format(filter="AND (u.user_id = ANY(%(ids)s) OR u.invited_by = ANY(%(ids)s))"),
+              {"ids": list(user_ids), "points": INVITE_REWARD_POINTS})
+    return c.fetchall()
+
+
+def reconcile_invite_rewards():
+    """一次性补发所有满足条件但尚未发放的邀请奖励。"""
+    with get_conn("reconcile_invite_rewards") as conn, conn.cursor() as c:
+        _lock_invite_rewards(c)
+        c.execute(GRANT_INVITE_REWARDS_SQL.format(filter=""), {"points": INVITE_REWARD_POINTS})
+        rows = c.fetchall()
+    rewards = sum(row[2] for row in rows)
+    logging.info(f"🎁 邀请奖励对账完成：{len(rows)} 位邀请人，共补发 {rewards} 份奖励")
+    return rows
+
+
+class InviteRewardWorker:
+    """后台发放邀请奖励：攒批后用一条语句处理，再通过 outbox 通知邀请人。"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._queue = None
+        self._pending = set()
+
+    def submit(self, user_id):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if user_id in self._pending:
+            return
+        self._pending.add(user_id)
+        self._queue.put_nowait(user_id)
+
+    async def run(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._pending.difference_update(batch)
+            try:
+                rows = await db.arun(_grant_invite_rewards, batch)
+            except Exception as e:
+                logging.error(f"奖励邀请者失败: {e}")
+                continue
+            coordinator.emit("points", [(inviter, inviter_points) for inviter, inviter_points, _ in rows])
+            for inviter, inviter_points, rewards in rows:
+                self._notify(inviter, inviter_points, rewards)
+
+    def _notify(self, inviter, inviter_points, rewards):
+        if bot_application is None:
+            return
+        outbox.post(PRIORITY_NOTIFY, inviter, partial(
+            bot_application.bot.send_message,
+            chat_id=inviter,
+            text=f"🎉 你邀请的用户成功参与游戏，获得 +{INVITE_REWARD_POINTS * rewards} 积分奖励！\n🏆 当前总积分：{inviter_points}\n继续邀请更多好友，积分越多越精彩！"
+        ))
+
+
+reward_worker = InviteRewardWorker(INVITE_REWARD_BATCH_SIZE)
+
+GAME_ROLL_DELAY = float(os.getenv("GAME_ROLL_DELAY", 3))
+# users.game_started_at 占用标记的有效期：实例在对局中途退出时，过期后用户可以重新开局
+GAME_CLAIM_TIMEOUT = float(os.getenv("GAME_CLAIM_TIMEOUT", 60))
+# 对局中的骰子在发送队列里最多等这么久，超时就中止对局并退还次数，不会超过占用标记的有效期
+GAME_SEND_MAX_WAIT = float(os.getenv("GAME_SEND_MAX_WAIT", GAME_CLAIM_TIMEOUT / 2))
+# sync：结算时同步写入 game_history；buffered：攒批写入，进程崩溃时最多丢失一个刷新周期的记录
+GAME_HISTORY_MODE = os.getenv("GAME_HISTORY_MODE", "sync")
+GAME_HISTORY_FLUSH_MS = int(os.getenv("GAME_HISTORY_FLUSH_MS", 500))
+GAME_HISTORY_BATCH_SIZE = int(os.getenv("GAME_HISTORY_BATCH_SIZE", 500))
+GAME_HISTORY_MAX_BUFFERED = int(os.getenv("GAME_HISTORY_MAX_BUFFERED", 50000))
+GAME_HISTORY_MAX_RETRIES = int(os.getenv("GAME_HISTORY_MAX_RETRIES", 5))
+
+# 正在进行中的对局（按用户），同一用户同一时间只能有一局
+_games_in_flight = set()
+
+
+@dataclass
+class DiceGame:
+    """一局骰子游戏的状态：掷骰 -> (机器人掷骰) -> 延迟结算。"""
+    user_id: int
+    chat_id: int
+    user_score: int = None
+    bot_score: int = None
+    reply_to_message_id: int = None
+    first_today: bool = False
+
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 100000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+
+class UserStateCache:
+    """按用户缓存游戏门控状态 (is_blocked, plays, 是否已授权手机号)，LRU + TTL。
+
+    状态变化的地方（授权、封禁、后台修改/删除、每日重置）必须显式失效。
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.day = date.today()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            # 跨天后缓存里的 plays 都是昨天的，不等每日重置任务，直接作废
+            if self.day != date.today():
+                self.day = date.today()
+                self._data.clear()
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl, tuple(state))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+user_states = UserStateCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def gate_rejected(state):
+    is_blocked, plays, authorized = state
+    return bool(is_blocked) or not authorized or plays >= 10
+
+
+def rejection_reason(state):
+    is_blocked, plays, authorized = state
+    return "unauthorized" if not authorized else "blocked" if is_blocked else "limit"
+
+
+class HistoryBuffer:
+    """game_history 写缓冲：每 flush_ms 毫秒或攒满 batch_size 行批量写入一次。
+
+    写入失败的行放回缓冲稍后重试；连续失败超过 max_retries 次或积压超过 max_rows 行时丢弃并记日志，
+    数据库长时间不可用时内存不会无限增长。
+    """
+
+    def __init__(self, enabled, flush_ms, batch_size, max_rows, max_retries):
+        self.enabled = enabled
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.max_retries = max_retries
+        self._rows = []
+        self._failures = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def add(self, row):
+        # 只在结算事务提交之后调用
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self._dropped += 1
+                if self._dropped % 1000 == 1:
+                    logging.error(f"游戏记录缓冲已满（{self.max_rows} 行），已丢弃 {self._dropped} 条")
+                return
+            self._rows.append(row)
+            full = len(self._rows) >= self.batch_size
+        if full and self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.flush(), self._loop)
+
+    async def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            await db.arun(_insert_history_rows, rows)
+        except Exception as e:
+            self._failures += 1
+            if self._failures > self.max_retries:
+                self._dropped += len(rows)
+                self._failures = 0
+                logging.error(f"游戏记录批量写入连续失败 {self.max_retries} 次，丢弃 {len(rows)} 条: {e}")
                 return
-            inviter, plays = row
-            if inviter and plays > 0:
-                # 检查是否已有奖励发放记录
-                c.execute("SELECT reward_given FROM invite_rewards WHERE inviter = %s AND invitee = %s", (inviter, user_id))
-                reward_row = c.fetchone()
-
-                if reward_row is None:
-                    # 还没有记录，插入一条未发放奖励记录
-                    c.execute("INSERT INTO invite_rewards (inviter, invitee, reward_given) VALUES (%s, %s, FALSE)", (inviter, user_id))
-                    conn.commit()
-                    reward_row = (False,)
-
-                if reward_row[0] is False:
-                    # 发放积分奖励
-                    c.execute("UPDATE users SET points = points + 10 WHERE user_id = %s RETURNING points", (inviter,))
-                    inviter_points = c.fetchone()[0]
-                    # 标记奖励已发放
-                    c.execute("UPDATE invite_rewards SET reward_given = TRUE WHERE inviter = %s AND invitee = %s", (inviter, user_id))
-                    conn.commit()
+            logging.error(f"游戏记录批量写入失败，{len(rows)} 条稍后重试: {e}")
+            with self._lock:
+                self._rows[:0] = rows[:max(0, self.max_rows - len(self._rows))]
+            return
+        self._failures = 0
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+def _insert_history_rows(c, rows):
+    execute_values(c, """
+        INSERT INTO game_history (user_id, created_at, user_score, bot_score, result, points_change)
+        VALUES %s
+    """, rows, page_size=len(rows))
+
+
+history_buffer = HistoryBuffer(GAME_HISTORY_MODE == "buffered", GAME_HISTORY_FLUSH_MS, GAME_HISTORY_BATCH_SIZE,
+                               GAME_HISTORY_MAX_BUFFERED, GAME_HISTORY_MAX_RETRIES)
+
+
+def _reserve_play(c, user_id):
+    # 原子地占用一次当日游戏次数，避免并发请求超过每日上限；
+    # 同时写入 game_started_at，多个实例同时收到同一用户的骰子时只有一个能开局
+    # 上次游戏在今天之前时 plays 视为 0，由这里完成跨天，不依赖每日重置任务已经处理到这一行
+    # 返回 (是否占用成功, (is_blocked, plays, 是否已授权手机号))，对局进行中时 state 为 None
+    today = today_start()
+    c.execute("""
+        UPDATE users
+        SET plays = CASE WHEN last_play IS NULL OR last_play < %(today)s THEN 1 ELSE plays + 1 END,
+            last_play = NOW(), game_started_at = NOW()
+        WHERE user_id = %(user_id)s AND is_blocked = 0 AND phone IS NOT NULL
+          AND (plays < 10 OR last_play IS NULL OR last_play < %(today)s)
+          AND (game_started_at IS NULL OR game_started_at < NOW() - make_interval(secs => %(timeout)s))
+        RETURNING plays
+    """, {"user_id": user_id, "today": today, "timeout": GAME_CLAIM_TIMEOUT})
+    row = c.fetchone()
+    if row:
+        return True, (0, row[0], True)
+    c.execute("""
+        SELECT is_blocked, CASE WHEN last_play >= %s THEN plays ELSE 0 END, phone IS NOT NULL,
+               game_started_at >= NOW() - make_interval(secs => %s)
+        FROM users WHERE user_id = %s
+    """, (today, GAME_CLAIM_TIMEOUT, user_id))
+    row = c.fetchone()
+    if row is None:
+        return False, (0, 0, False)
+    state, busy = row[:3], row[3]
+    if busy and not gate_rejected(state):
+        return False, None
+    return False, state
+
+
+async def reserve_play(user_id):
+    # 缓存中已确定会被拒绝（未授权 / 封禁 / 次数用完）的用户直接返回，不访问数据库
+    state = user_states.get(user_id)
+    if state is not None and gate_rejected(state):
+        game_rejections.inc(rejection_reason(state))
+        return False, state
+    reserved, state = await db.arun(_reserve_play, user_id)
+    if state is None:
+        game_rejections.inc("in_flight")
+        return False, None
+    user_states.set(user_id, state)
+    if not reserved:
+        game_rejections.inc(rejection_reason(state))
+    return reserved, state
+
+
+def _release_play(c, user_id):
+    # 昨天占用、今天才中止的对局不退还：那一次算在昨天，今天的次数会在下次开局时从 0 开始
+    c.execute("""
+        UPDATE users
+        SET plays = CASE WHEN last_play >= %s THEN GREATEST(plays - 1, 0) ELSE plays END,
+            game_started_at = NULL
+        WHERE user_id = %s
+    """, (today_start(), user_id))
+
+
+# 跨零点结算的对局算在开局那天：把 last_play 推到今天之前先把 plays 清零，否则昨天的次数会被带到今天
+SETTLE_USER_SET = """
+    points = points + %(score)s,
+    plays = CASE WHEN last_play IS NULL OR last_play < %(today)s THEN 0 ELSE plays END,
+    last_play = %(now_tz)s, game_started_at = NULL
+"""
+
+
+def _settle_game(c, user_id, score, user_score, bot_score):
+    # 返回 (points, username, first_name, history_row)；缓冲模式下 history_row 由调用方在提交后交给
+    # history_buffer，提交失败时不会留下多余的游戏记录，同步模式下为 None
+    now = datetime.now()
+    result = '赢' if score > 0 else '输' if score < 0 else '平局'
+    params = {"score": score, "today": today_start(), "now_tz": now.astimezone(), "user_id": user_id,
+              "now": now, "user_score": user_score, "bot_score": bot_score, "result": result}
+    if history_buffer.enabled:
+        c.execute(f"""
+            UPDATE users SET {SETTLE_USER_SET} WHERE user_id = %(user_id)s
+            RETURNING points, username, first_name
+        """, params)
+        points, username, first_name = c.fetchone()
+        return points, username, first_name, (user_id, now, user_score, bot_score, result, score)
+    # 积分更新与游戏记录写入合并为一条语句，一次往返
+    c.execute(f"""
+        WITH u AS (
+            UPDATE users SET {SETTLE_USER_SET}
+            WHERE user_id = %(user_id)s
+            RETURNING user_id, points, username, first_name
+        ), h AS (
+            INSERT INTO game_history (user_id, created_at, user_score, bot_score, result, points_change)
+            SELECT user_id, %(now)s, %(user_score)s, %(bot_score)s, %(result)s, %(score)s FROM u
+        )
+        SELECT points, username, first_name FROM u
+    """, params)
+    points, username, first_name = c.fetchone()
+    return points, username, first_name, None
 
-                    try:
-                        await context.bot.send_message(
-                            chat_id=inviter,
-                            text=f"🎉 你邀请的用户成功参与游戏，获得 +10 积分奖励！\n🏆 当前总积分：{inviter_points}\n继续邀请更多好友，积分越多越精彩！"
-                        )
-                    except Exception:
-                        logging.warning(f"邀请积分通知发送失败，邀请人ID: {inviter}")
+
+def schedule_game_step(step, bot, game):
+    scheduler.add_job(step, "date", args=[bot, game],
+                      run_date=datetime.now() + timedelta(seconds=GAME_ROLL_DELAY),
+                      misfire_grace_time=None)
+
+
+# 回调里创建的中止任务，保留引用以免被回收
+_game_tasks = set()
+
+
+def send_game_dice(bot, game, send, score_field, next_step):
+    """把对局里的一次掷骰交给发送队列，不在 handler 里等待。
+
+    群组限速时骰子可能排队很久，handler 一直等着会占住 PTB 的并发名额；这里发送完成后
+    在回调里记下点数并安排下一步，发送失败或排队超时则中止对局。
+    """
+    future = outbox.submit(PRIORITY_GAME, game.chat_id, send, max_wait=GAME_SEND_MAX_WAIT)
+
+    def done(future):
+        if future.cancelled():
+            return
+        try:
+            setattr(game, score_field, future.result().dice.value)
+        except Exception as e:
+            task = asyncio.ensure_future(abort_game(bot, game, e))
+            _game_tasks.add(task)
+            task.add_done_callback(_game_tasks.discard)
+            return
+        schedule_game_step(next_step, bot, game)
+    future.add_done_callback(done)
+
+
+async def abort_game(bot, game, e):
+    logging.error(f"游戏异常: {e}")
+    games_aborted.inc()
+    _games_in_flight.discard(game.user_id)
+    user_states.invalidate(game.user_id)
+    try:
+        await db.arun(_release_play, game.user_id)
+        # 对局中止多半是因为群组限速下排队超时：提示用最低优先级，同一会话里还没发出的提示合并成一条，
+        # 不再和正常对局抢令牌
+        outbox.post(PRIORITY_NOTIFY, game.chat_id, partial(
+            bot.send_message, chat_id=game.chat_id, text="⚠️ 游戏出错，请稍后再试。"),
+            coalesce_key=("game_error", game.chat_id))
     except Exception as e:
-        logging.error(f"奖励邀请者失败: {e}")
+        logging.error(f"游戏异常处理失败: {e}")
+
+
+@track_handler
+async def game_bot_roll(bot, game):
+    send_game_dice(bot, game, partial(bot.send_dice, chat_id=game.chat_id), "bot_score", game_settle)
+
+
+@track_handler
+async def game_settle(bot, game):
+    user_score, bot_score = game.user_score, game.bot_score
+    score = 10 if user_score > bot_score else -5 if user_score < bot_score else 0
+    try:
+        total, username, first_name, history_row = await db.arun(_settle_game, game.user_id, score,
+                                                                 user_score, bot_score)
+    except Exception as e:
+        await abort_game(bot, game, e)
+        return
+    if history_row is not None:
+        history_buffer.add(history_row)
+    _games_in_flight.discard(game.user_id)
+    games_total.inc("win" if score > 0 else "loss" if score < 0 else "draw")
+    coordinator.emit("settle", user_id=game.user_id, points=total, username=username, first_name=first_name,
+                     change=score)
+    if game.first_today:
+        # 被邀请人参与游戏后给邀请人发奖励（幂等，已发过的不会重复）
+        reward_worker.submit(game.user_id)
+
+    if score > 0:
+        result_emoji = "🎉🎉🎉"
+        result_text = f"你赢了！+10积分 {result_emoji}"
+    elif score < 0:
+        result_emoji = "😞💔"
+        result_text = f"你输了... -5积分 {result_emoji}"
+    else:
+        result_emoji = "😐"
+        result_text = f"平局！ {result_emoji}"
+
+    msg = (
+        f"🎲 你掷出 {user_score}，我掷出 {bot_score}！\n"
+        f"{result_text}\n"
+        f"📊 当前总积分：{total}"
+    )
 
+    help_button = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("❓ 玩法说明", callback_data="help_rules")]]
+    )
+    outbox.post(PRIORITY_GAME, game.chat_id, partial(
+        bot.send_message, chat_id=game.chat_id, text=msg, reply_markup=help_button,
+        reply_to_message_id=game.reply_to_message_id))
+
+@track_handler
 async def start_game_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user = query.from_user
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT is_blocked, plays, phone FROM users WHERE user_id = %s", (user.id,))
-        row = c.fetchone()
-    if not row:
-        await query.edit_message_text("⚠️ 你还未授权手机号，请先私聊我发送手机号授权。")
-        return
-    is_blocked, plays, phone = row
-    if is_blocked:
-        await query.edit_message_text("⛔️ 你已被禁止参与互动，请联系管理员。")
-        return
-    if not phone:
-        await query.edit_message_text("📵 请先授权手机号后才能参与游戏！")
+    if user.id in _games_in_flight:
+        await query.answer("⏳ 上一局还在进行中，请稍候～")
         return
-    if plays >= 10:
-        await query.edit_message_text("❌ 今天已用完10次机会，请明天再来！")
+    # 检查和占位之间不能有 await，否则两次并发点击都会通过检查
+    _games_in_flight.add(user.id)
+    try:
+        await query.answer()
+        reserved, state = await reserve_play(user.id)
+    except Exception:
+        _games_in_flight.discard(user.id)
+        raise
+    if not reserved:
+        _games_in_flight.discard(user.id)
+        if state is None:
+            # 另一个实例正在进行这个用户的对局
+            return
+        is_blocked, plays, phone = state
+        if is_blocked:
+            await query.edit_message_text("⛔️ 你已被禁止参与互动，请联系管理员。")
+        elif not phone:
+            await query.edit_message_text("📵 请先授权手机号后才能参与游戏！")
+        else:
+            await query.edit_message_text("❌ 今天已用完10次机会，请明天再来！")
         return
 
+    game = DiceGame(user_id=user.id, chat_id=query.message.chat_id, first_today=state[1] == 1)
     try:
         await query.delete_message()
-        dice1 = await context.bot.send_dice(chat_id=query.message.chat_id)
-        await asyncio.sleep(3)
-        dice2 = await context.bot.send_dice(chat_id=query.message.chat_id)
-        await asyncio.sleep(3)
-        score = 10 if dice1.dice.value > dice2.dice.value else -5 if dice1.dice.value < dice2.dice.value else 0
-
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute("UPDATE users SET points = points + %s, plays = plays + 1, last_play = %s WHERE user_id = %s",
-                      (score, datetime.now().isoformat(), user.id))
-            c.execute("""
-                INSERT INTO game_history (user_id, created_at, user_score, bot_score, result, points_change)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (user.id, datetime.now(), dice1.dice.value, dice2.dice.value,
-                  '赢' if score > 0 else '输' if score < 0 else '平局', score))
-            c.execute("SELECT points FROM users WHERE user_id = %s", (user.id,))
-            total = c.fetchone()[0]
-            conn.commit()
-
-        if score > 0:
-            result_emoji = "🎉🎉🎉"
-            result_text = f"你赢了！+10积分 {result_emoji}"
-        elif score < 0:
-            result_emoji = "😞💔"
-            result_text = f"你输了... -5积分 {result_emoji}"
-        else:
-            result_emoji = "😐"
-            result_text = f"平局！ {result_emoji}"
-
-        msg = (
-            f"🎲 你掷出 {dice1.dice.value}，我掷出 {dice2.dice.value}！\n"
-            f"{result_text}\n"
-            f"📊 当前总积分：{total}"
-        )
-
-        help_button = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("❓ 玩法说明", callback_data="help_rules")]]
-        )
-        await context.bot.send_message(chat_id=query.message.chat_id, text=msg, reply_markup=help_button)
     except Exception as e:
-        logging.error(f"游戏开始异常: {e}")
-        await query.message.reply_text("⚠️ 游戏出错，请稍后再试。")
+        await abort_game(context.bot, game, e)
+        return
+    send_game_dice(context.bot, game, partial(context.bot.send_dice, chat_id=game.chat_id),
+                   "user_score", game_bot_roll)
 
+@track_handler
 async def handle_group_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     dice = update.message.dice
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT is_blocked, plays, phone FROM users WHERE user_id = %s", (user.id,))
-        row = c.fetchone()
-    if not row or not row[2]:
-        bot_username = (await context.bot.get_me()).username
-        private_link = f"https://t.me/{bot_username}?start={user.id}"
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔐 点我授权手机号", url=private_link)]])
-        await update.message.reply_text(
-            f"📵 @{user.username or user.first_name} 请私聊我授权手机号后才能参与游戏！",
-            reply_markup=keyboard
-        )
-        return
-    is_blocked, plays, phone = row
-    if is_blocked:
-        await update.message.reply_text("⛔️ 你已被禁止参与，请联系管理员。")
-        return
-    if plays >= 10:
-        await update.message.reply_text("❌ 今天已用完10次机会，请明天再来！")
+    if user.id in _games_in_flight:
         return
-
+    _games_in_flight.add(user.id)
     try:
-        bot_msg = await update.message.reply_dice()
-        await asyncio.sleep(3)
-        user_score, bot_score = dice.value, bot_msg.dice.value
-        score = 10 if user_score > bot_score else -5 if user_score < bot_score else 0
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute("UPDATE users SET points = points + %s, plays = plays + 1, last_play = %s WHERE user_id = %s",
-                      (score, datetime.now().isoformat(), user.id))
-            c.execute("""
-                INSERT INTO game_history (user_id, created_at, user_score, bot_score, result, points_change)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (user.id, datetime.now(), user_score, bot_score,
-                  '赢' if score > 0 else '输' if score < 0 else '平局', score))
-            c.execute("SELECT points FROM users WHERE user_id = %s", (user.id,))
-            total = c.fetchone()[0]
-            conn.commit()
-
-        if score > 0:
-            result_emoji = "🎉🎉🎉"
-            result_text = f"你赢了！+10积分 {result_emoji}"
-        elif score < 0:
-            result_emoji = "😞💔"
-            result_text = f"你输了... -5积分 {result_emoji}"
+        reserved, state = await reserve_play(user.id)
+    except Exception:
+        _games_in_flight.discard(user.id)
+        raise
+    if not reserved:
+        _games_in_flight.discard(user.id)
+        if state is None:
+            # 另一个实例正在进行这个用户的对局
+            return
+        is_blocked, plays, phone = state
+        chat_id = update.effective_chat.id
+        # 同一用户在同一群里未发出的提示只保留一条
+        coalesce_key = ("gate", chat_id, user.id)
+        if not phone:
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔐 点我授权手机号", url=invite_link(context.bot, user.id))]])
+            outbox.post(PRIORITY_PROMPT, chat_id, partial(
+                update.message.reply_text,
+                f"📵 @{user.username or user.first_name} 请私聊我授权手机号后才能参与游戏！",
+                reply_markup=keyboard
+            ), coalesce_key)
+        elif is_blocked:
+            outbox.post(PRIORITY_PROMPT, chat_id, partial(
+                update.message.reply_text, "⛔️ 你已被禁止参与，请联系管理员。"), coalesce_key)
         else:
-            result_emoji = "😐"
-            result_text = f"平局！ {result_emoji}"
-
-        msg = (
-            f"🎲 你掷出 {user_score}，我掷出 {bot_score}！\n"
-            f"{result_text}\n"
-            f"📊 当前总积分：{total}"
-        )
+            outbox.post(PRIORITY_PROMPT, chat_id, partial(
+                update.message.reply_text, "❌ 今天已用完10次机会，请明天再来！"), coalesce_key)
+        return
 
-        help_button = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("❓ 玩法说明", callback_data="help_rules")]]
-        )
-        await update.message.reply_text(msg, reply_markup=help_button)
-    except Exception as e:
-        logging.error(f"群组骰子游戏异常: {e}")
-        await update.message.reply_text("⚠️ 游戏异常，请稍后重试。")
+    game = DiceGame(user_id=user.id, chat_id=update.effective_chat.id,
+                    user_score=dice.value, reply_to_message_id=update.message.message_id,
+                    first_today=state[1] == 1)
+    send_game_dice(context.bot, game, update.message.reply_dice, "bot_score", game_settle)
 
+@track_handler
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("""
-            SELECT points, plays, inviter_rewarded
-            FROM users WHERE user_id = %s
-        """, (user.id,))
-        row = c.fetchone()
+    row = await db.fetchone("""
+        SELECT points, CASE WHEN last_play >= %s THEN plays ELSE 0 END,
+               EXISTS(SELECT 1 FROM invite_rewards WHERE invitee = user_id AND reward_given)
+        FROM users WHERE user_id = %s
+    """, (today_start(), user.id), name="profile")
     if not row:
         await update.message.reply_text("⚠️ 你还未注册，请先发送 /start")
         return
@@ -578,38 +3362,183 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(msg)
 
+@track_handler
 async def invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    bot_name = (await context.bot.get_me()).username
-    invite_link = f"https://t.me/{bot_name}?start={user.id}"
     msg = (
         f"📢 你的邀请链接：\n"
-        f"{invite_link}\n\n"
+        f"{invite_link(context.bot, user.id)}\n\n"
         "邀请好友注册并参与游戏，双方都可获得积分奖励！"
     )
     await update.message.reply_text(msg)
 
+@track_handler
 async def show_rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    today = date.today().isoformat()
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("SELECT username, first_name, points FROM users WHERE last_play LIKE %s ORDER BY points DESC LIMIT 10", (f"{today}%",))
-        rows = c.fetchall()
-    if not rows:
-        await update.message.reply_text("📬 今日暂无玩家积分记录")
-        return
-    msg = "📊 今日排行榜：\n"
-    medals = ["🥇", "🥈", "🥉"] + ["🎖"] * 7
-    for i, row in enumerate(rows):
-        name = row[0] or row[1] or "匿名"
-        msg += f"{medals[i]} {name[:4]}*** - {row[2]} 分\n"
-    await update.message.reply_text(msg)
+    await update.message.reply_text(render_rank_message())
 
+@track_handler
 async def share(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    bot_name = (await context.bot.get_me()).username
-    link = f"https://t.me/{bot_name}?start={user.id}"
+    link = invite_link(context.bot, user.id)
     await update.message.reply_text(f"🔗 你的邀请链接：\n{link}\n\n🎁 邀请成功即可获得 +10 积分奖励！")
 
+JOIN_BUFFER_CAPACITY = int(os.getenv("JOIN_BUFFER_CAPACITY", 10000))
+JOIN_BATCH_SIZE = int(os.getenv("JOIN_BATCH_SIZE", 500))
+JOIN_FLUSH_MS = int(os.getenv("JOIN_FLUSH_MS", 200))
+
+
+# 新用户入库的同时维护邀请关系闭包：新用户（以及其注册前已有的下级）继承邀请人的全部上级，
+# 并按实际新增的闭包行给每个上级加团队人数。按 ancestor 排序更新 invite_stats，并发写入时加锁顺序一致，不会死锁。
+INSERT_USERS_SQL = """
+    WITH ins AS (
+        INSERT INTO users (user_id, first_name, last_name, username, invited_by, created_at)
+        VALUES %s
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING user_id, invited_by
+    ), links AS (
+        SELECT user_id AS descendant, invited_by AS ancestor, 1 AS depth FROM ins
+        WHERE invited_by IS NOT NULL AND invited_by <> user_id
+        UNION ALL
+        SELECT ins.user_id, c.ancestor, c.depth + 1
+        FROM ins JOIN invite_closure c ON c.descendant = ins.invited_by
+        WHERE c.ancestor <> ins.user_id
+    ), subtree AS (
+        -- 拉人进群时邀请人可能还没注册，已有的下级只挂在邀请人本人下面；
+        -- 邀请人注册后，这些下级也要挂到邀请人的新上级下面
+        SELECT c.descendant, l.ancestor, c.depth + l.depth AS depth
+        FROM links l JOIN invite_closure c ON c.ancestor = l.descendant
+        WHERE c.descendant <> l.ancestor
+    ), closure AS (
+        INSERT INTO invite_closure (descendant, ancestor, depth)
+        SELECT descendant, ancestor, depth FROM links
+        UNION ALL
+        SELECT descendant, ancestor, MIN(depth) FROM subtree GROUP BY descendant, ancestor
+        ON CONFLICT DO NOTHING
+        RETURNING ancestor, depth
+    ), stats AS (
+        INSERT INTO invite_stats AS s (user_id, direct, downline, max_depth)
+        SELECT ancestor, COUNT(*) FILTER (WHERE depth = 1), COUNT(*), MAX(depth)
+        FROM closure GROUP BY ancestor ORDER BY ancestor
+        ON CONFLICT (user_id) DO UPDATE SET
+            direct = s.direct + EXCLUDED.direct,
+            downline = s.downline + EXCLUDED.downline,
+            max_depth = GREATEST(s.max_depth, EXCLUDED.max_depth)
+    )
+    SELECT user_id, invited_by FROM ins
+"""
+
+
+def _lock_invite_closure(c):
+    # 闭包维护要读已提交的 invite_closure 行：两个事务同时写入邀请人和被邀请人时，
+    # 彼此都看不到对方未提交的行，中间那条闭包行就永远丢了。用事务级 advisory 锁串行化
+    # （跨实例、跨注册和批量入群），提交时自动释放
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (INVITE_CLOSURE_LOCK_ID,))
+
+
+def _insert_users(c, rows):
+    # rows: (user_id, first_name, last_name, username, invited_by)，已存在的用户保持不变
+    # 同一批里邀请人和被邀请人都是新用户时，邀请人的闭包行在同一条语句里还不可见，
+    # 所以先写邀请人所在的行，再写依赖它的行。返回真正新增的 [(user_id, invited_by)]
+    _lock_invite_closure(c)
+    pending = list(rows)
+    inserted = []
+    while pending:
+        new_ids = {row[0] for row in pending}
+        ready = [row for row in pending if row[4] not in new_ids]
+        waiting = [row for row in pending if row[4] in new_ids]
+        if not ready:
+            # 互相邀请成环，一起写入，闭包里不会出现环
+            ready, waiting = waiting, []
+        inserted += execute_values(c, INSERT_USERS_SQL, ready, template="(%s, %s, %s, %s, %s, NOW())",
+                                   page_size=len(ready), fetch=True)
+        pending = waiting
+    return inserted
+
+
+class JoinBuffer:
+    """新成员入群事件写入缓冲：攒满 batch_size 或每 flush_ms 毫秒批量写入一次。
+
+    缓冲区达到 capacity 时 add() 会等待写入完成，对入群事件形成背压。
+    """
+
+    def __init__(self, capacity, batch_size, flush_ms):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self._rows = {}
+        self._flush_now = None
+        self._space = None
+        self._stats = Counter()
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+
+    def _events(self):
+        if self._flush_now is None:
+            self._flush_now = asyncio.Event()
+            self._space = asyncio.Event()
+        return self._flush_now, self._space
+
+    async def add(self, row):
+        flush_now, space = self._events()
+        if len(self._rows) >= self.capacity:
+            self._stats["backpressure_waits"] += 1
+        while len(self._rows) >= self.capacity:
+            space.clear()
+            flush_now.set()
+            await space.wait()
+        # 同一批里重复的用户只保留第一次
+        self._rows.setdefault(row[0], row)
+        if len(self._rows) >= self.batch_size:
+            flush_now.set()
+
+    async def flush(self):
+        _, space = self._events()
+        while self._rows:
+            user_ids = list(itertools.islice(self._rows, self.batch_size))
+            batch = [self._rows.pop(user_id) for user_id in user_ids]
+            start = time.monotonic()
+            try:
+                inserted = await db.arun(_insert_users, batch)
+            except Exception as e:
+                logging.error(f"新成员批量写入失败，{len(batch)} 条稍后重试: {e}")
+                for row in batch:
+                    self._rows.setdefault(row[0], row)
+                return
+            finally:
+                space.set()
+            elapsed_ms = (time.monotonic() - start) * 1000
+            self._stats["batches"] += 1
+            self._stats["rows"] += len(batch)
+            self._last_flush_ms = elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+            if inserted:
+                coordinator.emit("joined", inserted)
+
+    async def run(self):
+        flush_now, _ = self._events()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(flush_now.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                flush_now.clear()
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["buffered"] = len(self._rows)
+        stats["avg_batch_size"] = round(stats.get("rows", 0) / stats["batches"], 1) if stats.get("batches") else 0
+        stats["last_flush_ms"] = round(self._last_flush_ms, 2)
+        stats["max_flush_ms"] = round(self._max_flush_ms, 2)
+        return stats
+
+
+join_buffer = JoinBuffer(JOIN_BUFFER_CAPACITY, JOIN_BATCH_SIZE, JOIN_FLUSH_MS)
+
+@track_handler
 async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_member = update.chat_member
     inviter = chat_member.from_user
@@ -617,16 +3546,45 @@ async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_member.old_chat_member.status == "left" and chat_member.new_chat_member.status == "member":
         if new_user.is_bot or inviter.id == new_user.id:
             return
-        with get_conn() as conn, conn.cursor() as c:
-            c.execute("SELECT 1 FROM users WHERE user_id = %s", (new_user.id,))
-            if not c.fetchone():
-                now = datetime.now().isoformat()
-                c.execute("INSERT INTO users (user_id, username, invited_by, created_at) VALUES (%s, %s, %s, %s)",
-                          (new_user.id, new_user.username or '', inviter.id, now))
-                conn.commit()
-
-async def run_telegram_bot():
-    app_ = ApplicationBuilder().token(BOT_TOKEN).build()
+        await join_buffer.add((new_user.id, new_user.first_name, new_user.last_name,
+                               new_user.username or '', inviter.id))
+
+# polling：长轮询（默认）；webhook：Telegram 把更新 POST 到本进程的 Hypercorn 服务
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# webhook 模式必填，Telegram 每次推送都会带上，用来拒绝伪造的更新
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_BODY = 1024 * 1024
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", 64))
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:8080")
+# inline：后台和机器人共用一个 Hypercorn 服务；separate：后台由 `python main.py web` 单独运行
+WEB_MODE = os.getenv("WEB_MODE", "inline")
+# Flask 请求处理线程数。每个线程最多占用一个数据库连接，默认只用连接池的一半，
+# 后台再忙也给机器人留出连接
+WEB_THREADS = int(os.getenv("WEB_THREADS", max(1, DB_POOL_MAX // 2)))
+WEB_PROCESSES = int(os.getenv("WEB_PROCESSES", 2))
+# separate 模式下机器人进程只提供 Webhook 和 /metrics，监听单独的地址
+WEBHOOK_BIND = os.getenv("WEBHOOK_BIND", "0.0.0.0:8081")
+
+bot_application = None
+
+
+def build_bot_application():
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .request(CountingRequest(connection_pool_size=BOT_CONNECTION_POOL_SIZE))
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app_ = builder.build()
     app_.add_handler(CommandHandler("start", start))
     app_.add_handler(CommandHandler("help", help_command))
     app_.add_handler(CommandHandler("profile", profile))
@@ -638,24 +3596,262 @@ async def run_telegram_bot():
     app_.add_handler(CallbackQueryHandler(start_game_callback, pattern="^start_game$"))
     app_.add_handler(CallbackQueryHandler(help_callback, pattern="^help_rules$"))
     app_.add_handler(ChatMemberHandler(handle_new_member, ChatMemberHandler.CHAT_MEMBER))
-    await app_.run_polling(close_loop=False)
+    return app_
+
+async def run_telegram_bot():
+    global bot_application
+    bot_application = build_bot_application()
+    if BOT_MODE != "webhook":
+        # chat_member 更新默认不会下发，需要显式订阅
+        await bot_application.run_polling(close_loop=False, allowed_updates=Update.ALL_TYPES)
+        return
+
+    await bot_application.initialize()
+    await bot_application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=BOT_CONCURRENT_UPDATES,
+    )
+    await bot_application.start()
+    logging.info(f"🤖 Webhook 模式已启动：{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await bot_application.stop()
+        await bot_application.shutdown()
+
+
+async def _send_plain(send, status, body=b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive, limit):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get("body", b""))
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return bytes(body)
 
-def reset_daily():
-    with get_conn() as conn, conn.cursor() as c:
-        c.execute("UPDATE users SET plays = 0")
-        conn.commit()
-    logging.info("🔄 已重置每日次数")
+
+async def handle_webhook(scope, receive, send):
+    if scope["method"] != "POST":
+        await _send_plain(send, 405)
+        return
+    headers = dict(scope["headers"])
+    token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET.encode()):
+        await _send_plain(send, 403)
+        return
+    body = await _read_body(receive, WEBHOOK_MAX_BODY)
+    if body is None:
+        await _send_plain(send, 413)
+        return
+    try:
+        update = Update.de_json(json.loads(body), bot_application.bot)
+    except Exception as e:
+        logging.warning(f"无法解析 Webhook 更新: {e}")
+        await _send_plain(send, 400)
+        return
+    try:
+        bot_application.update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # 队列满时让 Telegram 稍后重试，起到背压作用
+        logging.warning("更新队列已满，拒绝 Webhook 请求")
+        await _send_plain(send, 503)
+        return
+    await _send_plain(send, 200, b"OK")
+
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def handle_live_events(scope, receive, send):
+    """SSE：把 live_events 的事件原样写给浏览器，空闲时定期发注释行保活。"""
+    queue = live_events.subscribe()
+    if queue is None:
+        await _send_plain(send, 503, "实时推送连接数已满".encode())
+        return
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    get = None
+    try:
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            # 反向代理（nginx）不要缓冲，否则事件会攒着不发
+            (b"x-accel-buffering", b"no"),
+        ]})
+        await send({"type": "http.response.body", "body": f"retry: {LIVE_RETRY_MS}\n\n".encode(), "more_body": True})
+        while True:
+            get = get or asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({get, disconnected}, timeout=LIVE_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                break
+            if get not in done:
+                await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": True})
+                continue
+            # 把已经积压的事件一起发出去，减少写次数
+            messages = [get.result()]
+            get = None
+            while not queue.empty():
+                messages.append(queue.get_nowait())
+            closing = None in messages
+            await send({"type": "http.response.body", "more_body": not closing,
+                        "body": b"".join(m for m in messages if m is not None)})
+            if closing:
+                break
+    finally:
+        live_events.unsubscribe(queue)
+        disconnected.cancel()
+        if get is not None:
+            get.cancel()
+
+
+async def handle_lifespan(receive, send):
+    """独立后台进程开启多实例协调时，在启动阶段加入事件广播（不参与 leader 选举），
+    这样内存排行榜和实时推送能跟上机器人进程里的变化。"""
+    global leaderboard_live
+    listener = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if COORDINATION_ENABLED and not leaderboard_live:
+                listener = asyncio.create_task(coordinator.run(lead=False))
+                leaderboard.load(await db.arun(_load_leaderboard), replace=True)
+                leaderboard_live = True
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if listener is not None:
+                listener.cancel()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+wsgi_app = WSGIWrapper(app, WEBHOOK_MAX_BODY * 16)
+# Flask 是同步的，放在专用的有界线程池里执行，不占用事件循环，也不和默认线程池抢线程
+web_executor = ThreadPoolExecutor(max_workers=WEB_THREADS, thread_name_prefix="web")
+# 机器人进程，以及开启多实例协调的独立后台进程，会随结算事件更新内存排行榜
+leaderboard_live = False
+
+
+async def asgi_app(scope, receive, send):
+    """Hypercorn 入口：Webhook、/metrics 和 SSE 在事件循环中直接处理，其余请求交给 Flask。"""
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+    if (scope["type"] == "http" and scope["path"] == WEBHOOK_PATH
+            and BOT_MODE == "webhook" and bot_application is not None):
+        await handle_webhook(scope, receive, send)
+        return
+    if scope["type"] == "http" and scope["path"] == "/metrics":
+        await _send_plain(send, 200, render_metrics().encode())
+        return
+    if scope["type"] == "http" and WEB_MODE == "separate" and bot_application is not None:
+        await _send_plain(send, 404)
+        return
+    if scope["type"] == "http" and scope["path"] == LIVE_PATH:
+        await handle_live_events(scope, receive, send)
+        return
+    loop = asyncio.get_running_loop()
+
+    def call_soon(func, *args):
+        return asyncio.run_coroutine_threadsafe(func(*args), loop).result()
+
+    await wsgi_app(scope, receive, send, partial(loop.run_in_executor, web_executor), call_soon)
+
+RESET_BATCH_SIZE = int(os.getenv("RESET_BATCH_SIZE", 5000))
+
+# 定时任务最近一次执行情况
+job_stats = {}
+
+
+def _reset_plays_batch(c, cutoff, batch_size):
+    # 跨天由开局 / 结算自己处理，这里只是把后台和 /profile 之外直接读 plays 的地方清理干净：
+    # 只处理今天之前玩过的行；被正在进行的对局锁住的行跳过，下一批再处理
+    c.execute("""
+        WITH batch AS (
+            SELECT user_id FROM users
+            WHERE plays > 0 AND (last_play IS NULL OR last_play < %s)
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE users u SET plays = 0
+        FROM batch WHERE u.user_id = batch.user_id
+    """, (cutoff, batch_size))
+    return c.rowcount
+
+@leader_only
+async def reset_daily():
+    start = time.monotonic()
+    cutoff = today_start()
+    total = batches = 0
+    while True:
+        count = await db.arun(_reset_plays_batch, cutoff, RESET_BATCH_SIZE)
+        if not count:
+            break
+        total += count
+        batches += 1
+        user_states.clear()
+        logging.debug(f"重置每日次数：第 {batches} 批，累计 {total} 行")
+    coordinator.emit("reset")
+    duration = time.monotonic() - start
+    job_seconds.observe(duration, "reset_daily")
+    job_stats["reset_daily"] = {
+        "finished_at": datetime.now().isoformat(),
+        "rows": total,
+        "batches": batches,
+        "duration_seconds": round(duration, 3),
+    }
+    logging.info(f"🔄 已重置每日次数：{total} 行，{batches} 批，用时 {duration:.2f}s")
+
+def serve_web():
+    """WEB_MODE=separate 时单独运行后台：多个 Hypercorn 工作进程，和机器人互不影响。"""
+    config = Config()
+    config.bind = [WEB_BIND]
+    config.workers = WEB_PROCESSES
+    config.application_path = "main:asgi_app"
+    hypercorn_run(config)
 
 async def main():
+    global leaderboard_live
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # 没有密钥时任何能访问 Webhook 路径的人都能伪造更新（比如伪造骰子点数刷积分）
+        raise RuntimeError("BOT_MODE=webhook 时必须设置 WEBHOOK_SECRET")
     init_db()
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(reset_daily, "cron", hour=0, minute=0)
+    leaderboard.load(db.run(_load_leaderboard))
+    leaderboard_live = True
+    scheduler.add_job(reset_daily, "cron", hour=0, minute=0, coalesce=True, misfire_grace_time=3600)
+    scheduler.add_job(refresh_bot_profile, "interval", hours=BOT_PROFILE_REFRESH_HOURS, coalesce=True)
+    scheduler.add_job(maintain_history_partitions, "cron", hour=0, minute=30, coalesce=True, misfire_grace_time=3600)
+    scheduler.add_job(rollup_game_history, "interval", seconds=ROLLUP_INTERVAL_SECONDS,
+                      coalesce=True, max_instances=1)
     scheduler.start()
+    tasks = [run_telegram_bot(), outbox.run(), reward_worker.run(), join_buffer.run(), coordinator.run()]
     config = Config()
-    config.bind = ["0.0.0.0:8080"]
-    web_task = serve(app, config)
-    bot_task = run_telegram_bot()
-    await asyncio.gather(web_task, bot_task)
+    config.bind = [WEB_BIND if WEB_MODE != "separate" else WEBHOOK_BIND]
+    tasks.append(serve(asgi_app, config))
+    if history_buffer.enabled:
+        tasks.append(history_buffer.run())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        web_executor.shutdown(wait=False)
+        db.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:] == ["migrate"]:
+        run_migrations()
+    elif sys.argv[1:] == ["reconcile_rewards"]:
+        reconcile_invite_rewards()
+    elif sys.argv[1:] == ["web"]:
+        serve_web()
+    else:
+        asyncio.run(main())